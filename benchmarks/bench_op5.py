@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import op5
+import op5mock
+
+# Benchmarks of the client's hot paths against a local mock OP5 server.
+# Usage: python benchmarks/bench_op5.py --counts 100,1000 [--latency 0.002] [--save results.json] [--compare results.json]
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Benchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.out = sys.stdout
+
+    def setup(self, hosts=0, services_per_host=0, saved=True):
+        server = op5mock.MockOP5Server().start()
+        for i in range(hosts):
+            server.store.add("host", {"host_name": "host%d" % i, "address": "10.0.%d.%d" % (i / 256, i % 256), "hostgroups": ["group%d" % (i % 10)]}, saved)
+            for j in range(services_per_host):
+                server.store.add("service", {"host_name": "host%d" % i, "service_description": "service%d" % j, "check_command": "check_dummy"}, saved)
+        #latency and faults are only injected after setting up, so that they do not affect setup time
+        server.store.latency = self.args.latency
+        server.store.export_latency = self.args.export_latency
+        server.store.fail_509_rate = self.args.fail_509_rate
+        client = op5.OP5(server.url, "user", "password", interactive=True, retry_wait=0.01, max_retries=10)
+        return server, client
+
+    #calls func once per item, and records the latency of each call
+    def measure(self, name, count, func, items):
+        latencies = []
+        start = time.time()
+        for item in items:
+            call_start = time.time()
+            func(item)
+            latencies.append(time.time() - call_start)
+        self.record(name, count, time.time() - start, latencies)
+
+    def record(self, name, count, total, latencies, operations=None):
+        operations = operations or len(latencies)
+        result = {"name": name, "count": count, "operations": operations, "total": total,
+                  "ops_per_second": operations / total if total else 0.0,
+                  "p50_ms": percentile(latencies, 0.5) * 1000, "p95_ms": percentile(latencies, 0.95) * 1000}
+        self.results.append(result)
+        print >>self.out, "%-24s %8d %10.3f %12.1f %10.2f %10.2f" % (name, count, total, result["ops_per_second"], result["p50_ms"], result["p95_ms"])
+
+    def bench_create(self, count):
+        server, client = self.setup()
+        self.measure("create", count, lambda i: client.create("host", {"host_name": "host%d" % i, "address": "10.0.0.1"}), range(count))
+        client.close()
+        server.stop()
+
+    def bench_sync(self, count):
+        desired = [{"host_name": "host%d" % i, "address": "10.0.%d.%d" % (i / 256, i % 256), "hostgroups": ["group%d" % (i % 10)]} for i in range(count)]
+        for data in desired[::10]: #10% of the objects need an update
+            data["address"] = "192.168.0.1"
+
+        server, client = self.setup(hosts=count)
+        self.measure("sync", count, lambda data: client.sync("host", data["host_name"], data), desired)
+        client.close()
+        server.stop()
+
+        server, client = self.setup(hosts=count)
+        start = time.time()
+        client.sync_many("host", desired)
+        total = time.time() - start
+        self.record("sync_many", count, total, [total], count)
+        client.close()
+        server.stop()
+
+    def bench_commit_changes(self, count):
+        server, client = self.setup(hosts=count, saved=False)
+        server.store.changes = [{"type": "create", "object_type": "host", "name": "host%d" % i} for i in range(count)]
+        client.modified = True
+        self.measure("commit_changes", count, lambda i: client.commit_changes(), range(1))
+        client.close()
+        server.stop()
+
+    def bench_filter(self, count):
+        server, client = self.setup(hosts=count / 10 or 1, services_per_host=10)
+        self.measure("filter", count, lambda i: client.filter("query", "[services] all"), range(1))
+        start = time.time()
+        rows = sum(1 for row in client.iter_filter("[services] all", columns=["host_name", "description", "state"], page_size=self.args.page_size))
+        total = time.time() - start
+        self.record("iter_filter", count, total, [total], rows)
+        client.close()
+        server.stop()
+
+    def bench_command(self, count):
+        server, client = self.setup()
+        results = [{"host_name": "host%d" % (i % 100), "service_description": "service%d" % (i % 10), "status_code": i % 3, "plugin_output": "output %d" % i} for i in range(count)]
+        self.measure("command", count, lambda data: client.command("PROCESS_SERVICE_CHECK_RESULT", data), results)
+        client.close()
+        server.stop()
+
+    def bench_check_result_queue(self, count):
+        server, client = self.setup()
+        start = time.time()
+        with client.check_result_queue(max_size=count, flush_size=min(count, 500)) as queue:
+            for i in range(count):
+                queue.submit("host%d" % (i % 100), "service%d" % (i / 100), i % 3, "output %d" % i)
+        total = time.time() - start
+        self.record("check_result_queue", count, total, [total], count)
+        client.close()
+        server.stop()
+
+    def run(self):
+        print >>self.out, "%-24s %8s %10s %12s %10s %10s" % ("benchmark", "count", "total (s)", "ops/s", "p50 (ms)", "p95 (ms)")
+        if not self.args.verbose: #hide the status text that op5.py prints for every call
+            sys.stdout = open(os.devnull, "w")
+        try:
+            for count in self.args.counts:
+                for name in self.args.benchmarks:
+                    getattr(self, "bench_" + name)(count)
+        finally:
+            sys.stdout = self.out
+        return self.results
+
+#compares results with a saved run, and returns the benchmarks whose throughput dropped by more than tolerance
+def compare(results, baseline, tolerance):
+    previous = dict(((result["name"], result["count"]), result) for result in baseline)
+    regressions = []
+    for result in results:
+        key = (result["name"], result["count"])
+        if key in previous and result["ops_per_second"] < previous[key]["ops_per_second"] * (1 - tolerance):
+            regressions.append((result, previous[key]))
+    return regressions
+
+def main(argv):
+    benchmarks = ["create", "sync", "commit_changes", "filter", "command", "check_result_queue"]
+    parser = argparse.ArgumentParser(description="Benchmarks op5.py against a local mock OP5 server")
+    parser.add_argument("--counts", default="100,1000", help="comma separated object counts")
+    parser.add_argument("--benchmarks", default=",".join(benchmarks), help="comma separated subset of: %s" % ", ".join(benchmarks))
+    parser.add_argument("--latency", type=float, default=0, help="seconds of latency per request")
+    parser.add_argument("--export-latency", type=float, default=0, help="seconds that a commit takes")
+    parser.add_argument("--fail-509-rate", type=float, default=0, help="probability of HTTP 509 for any request")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--verbose", action="store_true", help="show the output of op5.py")
+    parser.add_argument("--save", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="compare with results saved by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop when comparing, as a fraction")
+    args = parser.parse_args(argv)
+    args.counts = [int(count) for count in args.counts.split(",")]
+    args.benchmarks = args.benchmarks.split(",")
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("unknown benchmark: %s" % name)
+
+    results = Benchmark(args).run()
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for result, previous in regressions:
+            print "REGRESSION: %s (%d): %.1f ops/s, was %.1f ops/s" % (result["name"], result["count"], result["ops_per_second"], previous["ops_per_second"])
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
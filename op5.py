@@ -1,10 +1,21 @@
 from urllib import quote
 import requests #pip install requests
 import json
+import os
+import hashlib
+import tempfile
+import mmap
+import socket
 
 from termcolor import colored #pip install termcolor
 import time
 import sys
+import random
+import email.utils
+import copy
+import threading
+import Queue
+from collections import OrderedDict, namedtuple, deque
 
 import logging
 logger = logging.getLogger("op5")
@@ -23,22 +34,1330 @@ class NullHandler(logging.Handler):
 
 logger.addHandler(NullHandler())
 
+class DebugText(object):
+    """
+    Defers building the text of OP5.get_debug_text() until a log handler actually formats the message
+    """
+    def __init__(self, op5, request_type, object_type, name, data):
+        self.op5 = op5
+        self.args = (request_type, object_type, name, data)
+    def __str__(self):
+        return self.op5.get_debug_text(*self.args)
+
+class Stats(object):
+    """
+    Request metrics of an OP5 object, broken down by request type and object type.
+    Listeners are called with a dictionary for every HTTP request, retry, decoded response and commit.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.status_codes = {}
+            self.retries = 0
+            self.commits = {"count": 0, "failed": 0, "time": 0.0, "max_time": 0.0}
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    #a failing listener is logged, and does not fail the request that it was called for
+    def notify(self, event):
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception:
+                logger.exception("Stats listener %r failed on event: %s", listener, event)
+
+    def get_entry(self, request_type, object_type):
+        key = "%s %s" % (request_type, object_type)
+        if key not in self.requests:
+            self.requests[key] = {"count": 0, "time": 0.0, "max_time": 0.0, "server_time": 0.0, "decode_count": 0, "decode_time": 0.0, "bytes_sent": 0, "bytes_received": 0}
+        return self.requests[key]
+
+    #wall_time: from sending the request until the body was read
+    #server_time: until the response headers were parsed, which includes connecting when a new connection was opened
+    def record_request(self, request_type, object_type, status_code, wall_time, server_time, bytes_sent, bytes_received):
+        with self.lock:
+            entry = self.get_entry(request_type, object_type)
+            entry["count"] += 1
+            entry["time"] += wall_time
+            entry["max_time"] = max(entry["max_time"], wall_time)
+            entry["server_time"] += server_time
+            entry["bytes_sent"] += bytes_sent
+            entry["bytes_received"] += bytes_received
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+        if self.listeners:
+            self.notify({"event": "request", "request_type": request_type, "object_type": object_type, "status_code": status_code,
+                         "time": wall_time, "server_time": server_time, "transfer_time": max(wall_time - server_time, 0),
+                         "bytes_sent": bytes_sent, "bytes_received": bytes_received})
+
+    def record_retry(self, request_type, object_type, status_code, delay):
+        with self.lock:
+            self.retries += 1
+        if self.listeners:
+            self.notify({"event": "retry", "request_type": request_type, "object_type": object_type, "status_code": status_code, "delay": delay})
+
+    def record_decode(self, request_type, object_type, decode_time):
+        with self.lock:
+            entry = self.get_entry(request_type, object_type)
+            entry["decode_count"] += 1
+            entry["decode_time"] += decode_time
+        if self.listeners:
+            self.notify({"event": "decode", "request_type": request_type, "object_type": object_type, "time": decode_time})
+
+    def record_commit(self, commit_time, success):
+        with self.lock:
+            self.commits["count"] += 1
+            self.commits["failed"] += 0 if success else 1
+            self.commits["time"] += commit_time
+            self.commits["max_time"] = max(self.commits["max_time"], commit_time)
+        if self.listeners:
+            self.notify({"event": "commit", "time": commit_time, "success": success})
+
+    #returns a copy of everything collected so far
+    def snapshot(self):
+        with self.lock:
+            return {"requests": copy.deepcopy(self.requests), "status_codes": dict(self.status_codes), "retries": self.retries, "commits": dict(self.commits)}
+
+#the outcome of a single call, for APIs that run many calls at once
+Result = namedtuple("Result", ["success", "status_code", "data"])
+
+#like itertools.imap, but runs func in up to max_workers threads. Results are yielded in input order, and an exception raised by func is re-raised
+def parallel_imap(func, items, max_workers=8):
+    tasks = Queue.Queue()
+    results = {}
+    done = threading.Condition()
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, item = task
+            try:
+                result = (True, func(item))
+            except Exception as e:
+                result = (False, e)
+            with done:
+                results[index] = result
+                done.notify_all()
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, max_workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    items = iter(items)
+    submitted = 0
+    try:
+        for item in items: #only keep a bounded number of items in flight, so that items can be a generator
+            tasks.put((submitted, item))
+            submitted += 1
+            if submitted >= 2 * len(threads):
+                break
+        index = 0
+        while index < submitted:
+            with done:
+                while index not in results:
+                    done.wait(1)
+                success, value = results.pop(index)
+            for item in items:
+                tasks.put((submitted, item))
+                submitted += 1
+                break
+            index += 1
+            if not success:
+                raise value
+            yield value
+    finally:
+        for thread in threads:
+            tasks.put(None)
+
+def parallel_map(func, items, max_workers=8):
+    return list(parallel_imap(func, items, max_workers))
+
+#returns the number of seconds to wait according to a Retry-After header value, or None if it is not set or not understood
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+#raised to the caller when a call can not be finished within the total_timeout of an OP5 object
+class TotalTimeoutError(RuntimeError):
+    pass
+
+class Throttle(object):
+    """
+    Client-side rate limiting, shared by every request of one or more OP5 objects.
+    A token bucket limits the request rate, and after a 509 or 500 all users of the throttle wait for an
+    exponential backoff with jitter. Clustered 509s lengthen the backoff and lower the rate, which recovers on successes.
+    """
+    def __init__(self, rate=None, burst=10, backoff_base=6, backoff_max=120, cluster_window=60):
+        self.rate = rate #requests per second, None means no limit
+        self.burst = burst
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cluster_window = cluster_window
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.rate_factor = 1.0
+        self.blocked_until = 0
+        self.recent_509s = []
+        self.lock = threading.Lock()
+
+    #blocks until a request may be sent
+    def acquire(self, deadline=None):
+        while True:
+            with self.lock:
+                now = time.time()
+                wait = self.blocked_until - now
+                if self.rate:
+                    rate = self.rate * self.rate_factor
+                    self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * rate)
+                    self.last_refill = now
+                    if wait <= 0 and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = max(wait, (1 - self.tokens) / rate)
+                elif wait <= 0:
+                    return
+            if deadline is not None and now + wait >= deadline:
+                raise TotalTimeoutError("Bailing out since waiting %.1f seconds to send a request would exceed the total timeout" % wait)
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.rate_factor = min(1.0, self.rate_factor + 0.05)
+
+    #registers a failed attempt, and returns the number of seconds that everyone waits before the next request
+    def backoff(self, status_code, attempt, retry_after=None):
+        with self.lock:
+            now = time.time()
+            if status_code == 509:
+                self.recent_509s = [t for t in self.recent_509s if t > now - self.cluster_window] + [now]
+                self.rate_factor = max(0.05, self.rate_factor / 2)
+                attempt = max(attempt, len(self.recent_509s))
+            if retry_after is None:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                delay = delay / 2.0 + random.uniform(0, delay / 2.0) #jitter, so that many clients do not retry in lockstep
+            else:
+                delay = retry_after
+            self.blocked_until = max(self.blocked_until, now + delay)
+            return delay
+
+OBJECT_TYPES = ["host","hostgroup","service","servicegroup","contact","contactgroup","host_template","service_template",
+                "contact_template","hostdependency","servicedependency","hostescalation","serviceescalation","user","usergroup",
+                "combined_graph","graph_collection","graph_template","management_pack","timeperiod","command"]
+
+# Properties that have to be set when creating an object. Sublists denote that either of the values need to be present, but not both
+REQUIRED_PROPERTIES = {
+    "command":           ["command_line", "command_name"],
+    "contact":           ["alias", "contact_name"],
+    "graph_template":    ["check"],
+    "hostdependency":    ["dependent_host_name", "host_name"],
+    "hostescalation":    ["first_notification", "host_name", "last_notification", "notification_interval"],
+    "service":           [["host_name", "hostgroup_name"], "service_description"],
+    "servicedependency": ["dependent_service", "service"],
+    "user":              ["username", "password"],
+}
+
+def get_required_properties(object_type):
+    if object_type in REQUIRED_PROPERTIES:
+        return REQUIRED_PROPERTIES[object_type]
+    return [["name", object_type+"_name"]]
+
+#returns the name that the OP5 API uses for an object, or None if it can not be derived from the object's data
+def get_object_name(object_type, data):
+    if object_type == "service":
+        parent = data.get("host_name") or data.get("hostgroup_name")
+        if parent and "service_description" in data:
+            return "%s;%s" % (parent, data["service_description"])
+        return None
+    for key in [object_type+"_name", "name", "username"]:
+        if key in data:
+            return data[key]
+    return None
+
+#returns True if a listing entry is only a reference to the object ({"name": ..., "resource": ...}) instead of the full object
+def is_reference_only(data):
+    return set(data.keys()) <= set(["name","resource"])
+
+# Writes to an object type can change the objects of these types as well (e.g. group memberships, or services of a deleted host)
+RELATED_OBJECT_TYPES = {
+    "host":         ["hostgroup","service"],
+    "hostgroup":    ["host","service"],
+    "service":      ["servicegroup"],
+    "servicegroup": ["service"],
+    "contact":      ["contactgroup"],
+    "contactgroup": ["contact"],
+    "user":         ["usergroup"],
+    "usergroup":    ["user"],
+}
+
+class ConfigCache(object):
+    """
+    Read-through cache for /config objects, keyed by (object_type, name).
+    Entries expire after ttl seconds, and the least recently used entries are evicted beyond max_size.
+    """
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    #returns a (status_code, data) tuple, or None on a cache miss
+    def get(self, object_type, name):
+        key = (object_type, name)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = entry #re-insert to mark as most recently used
+            self.hits += 1
+            return entry[1], copy.deepcopy(entry[2])
+
+    def set(self, object_type, name, status_code, data):
+        key = (object_type, name)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, status_code, copy.deepcopy(data))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    #removes the object, the listing of its object type, and everything of the related object types
+    def invalidate(self, object_type, name=None):
+        with self.lock:
+            self.entries.pop((object_type, name), None)
+            self.entries.pop((object_type, ""), None)
+            related = RELATED_OBJECT_TYPES.get(object_type, [])
+            for key in [key for key in self.entries if key[0] in related]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+# The members of these group types are listed in a property of the member objects, e.g. the "hostgroups" of each host
+GROUP_MEMBER_PROPERTIES = {
+    "hostgroup":    ("host","hostgroups"),
+    "servicegroup": ("service","servicegroups"),
+    "contactgroup": ("contact","contactgroups"),
+}
+
+MISSING = object()
+
+class CompactRecord(object):
+    """
+    A read-only, dictionary-like view of one object of a CompactListing.
+    List values are returned as new lists, so they can be compared and changed like those of a decoded object.
+    """
+    __slots__ = ("listing", "row")
+
+    def __init__(self, listing, row):
+        self.listing = listing
+        self.row = row
+
+    def __getitem__(self, key):
+        column = self.listing.columns.get(key)
+        value = MISSING if column is None else column[self.row]
+        if value is MISSING:
+            raise KeyError(key)
+        return list(value) if type(value) is tuple else value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        column = self.listing.columns.get(key)
+        return column is not None and column[self.row] is not MISSING
+
+    def keys(self):
+        return [key for key, column in self.listing.columns.items() if column[self.row] is not MISSING]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return dict(self) == (dict(other) if isinstance(other, CompactRecord) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class CompactListing(object):
+    """
+    A listing of /config objects (as returned by read(object_type, "")) that is stored as one list per property instead of one dictionary per object.
+    Equal strings and lists of strings are stored once, and objects can be looked up by name, and by the values of a list property (e.g. hosts by hostgroup).
+    It is not changed after it is made, so it can be shared between threads and cached without copying.
+    """
+    def __init__(self, object_type, objects):
+        self.object_type = object_type
+        self.columns = OrderedDict()
+        self.strings = {}
+        self.count = 0
+        self.names = {}
+        self.indexes = {}
+        self.lock = threading.Lock()
+        for data in objects:
+            for key, value in data.items():
+                column = self.columns.get(key)
+                if column is None:
+                    column = self.columns[self.intern(key)] = [MISSING] * self.count
+                column.append(self.intern(value))
+            self.count += 1
+            for column in self.columns.values():
+                if len(column) < self.count:
+                    column.append(MISSING)
+            name = get_object_name(object_type, data) or data.get("name")
+            if name is not None:
+                self.names[self.intern(name)] = self.count - 1
+        self.strings = None #only needed while building
+
+    #returns one stored copy of equal values, and stores lists as tuples
+    def intern(self, value):
+        if isinstance(value, list):
+            value = tuple(self.intern(item) for item in value)
+        elif not isinstance(value, basestring):
+            return value
+        try:
+            return self.strings.setdefault(value, value)
+        except TypeError: #a tuple with unhashable items
+            return value
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.count
+        if not 0 <= row < self.count:
+            raise IndexError(row)
+        return CompactRecord(self, row)
+
+    def __iter__(self):
+        for row in xrange(self.count):
+            yield CompactRecord(self, row)
+
+    def __deepcopy__(self, memo): #it is never changed, so ConfigCache does not have to copy it
+        return self
+
+    #returns the object with the given name as a CompactRecord, or None
+    def get(self, name):
+        row = self.names.get(name)
+        return None if row is None else CompactRecord(self, row)
+
+    #returns the names of the objects whose list property contains value, e.g. find("hostgroups","linux-servers") on a host listing
+    #the index of a property is built on first use
+    def find(self, key, value):
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None:
+                index = self.indexes[key] = {}
+                names = dict((row, name) for name, row in self.names.items())
+                for row, values in enumerate(self.columns.get(key, [])):
+                    if type(values) is tuple:
+                        for item in values:
+                            index.setdefault(item, []).append(names.get(row))
+        return list(index.get(value, []))
+
+    #returns a list of plain dictionaries
+    def to_list(self):
+        return [dict(record) for record in self]
+
+# Changes are sent in this order, so that objects exist before other objects refer to them. Deletes are sent in the reverse order.
+DEPENDENCY_ORDER = [
+    ["command","timeperiod"],
+    ["host_template","service_template","contact_template","hostgroup","servicegroup","contactgroup","usergroup","contact","user"],
+    ["host"],
+    ["service","hostdependency","servicedependency","hostescalation","serviceescalation"],
+]
+
+def get_dependency_tier(object_type):
+    for tier, object_types in enumerate(DEPENDENCY_ORDER):
+        if object_type in object_types:
+            return tier
+    return len(DEPENDENCY_ORDER) #anything else (e.g. graphs and management packs) goes last
+
+class ChangeBatch(object):
+    """
+    Queues create/update/overwrite/delete calls, coalesces the calls made to the same object,
+    and sends them in dependency order followed by a single commit. Usable as a context manager:
+    the batch is flushed when the block exits, unless it exits with an exception.
+    """
+    def __init__(self, op5):
+        self.op5 = op5
+        self.changes = OrderedDict() #(object_type, name) -> [request_type, data]
+        self.coalesced = 0
+        self.result = None
+        self.failed = [] #(object_type, name) of the requests that failed in the last flush(keep_going=True)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.result = self.flush()
+        else:
+            self.changes.clear()
+        return False
+
+    def queue(self, request_type, object_type, name, data):
+        fname = sys._getframe(1).f_code.co_name
+        if not self.op5.validate_request(request_type, object_type, name, data, use_schema=False): #the schema checks the whole batch in flush()
+            return False
+        if name is None: #objects without a derivable name can not be coalesced
+            key = (object_type, len(self.changes))
+        else:
+            key = (object_type, name)
+        if key not in self.changes:
+            self.changes[key] = [request_type, copy.deepcopy(data)]
+            return True
+
+        change = self.changes[key]
+        previous_type = change[0]
+        self.coalesced += 1
+        if request_type == "DELETE":
+            if previous_type == "POST": #the object was never sent, so there is nothing to delete
+                del self.changes[key]
+            else:
+                self.changes[key] = ["DELETE", None]
+        elif previous_type == "DELETE" and request_type == "POST": #delete followed by create is a replace
+            self.changes[key] = ["PUT", copy.deepcopy(data)]
+        elif previous_type == "DELETE" or request_type == "POST":
+            self.coalesced -= 1
+            print colored("%s(%s): Conflicts with a queued %s request! name: '%s' data: %s" % (fname, object_type, previous_type, name, str(data)), "red")
+            return False
+        elif request_type == "PATCH":
+            change[1].update(copy.deepcopy(data))
+        else: #PUT replaces all earlier data, but a queued create stays a create
+            change[1] = copy.deepcopy(data)
+        return True
+
+    def create(self, object_type, data_dict):
+        return self.queue("POST", object_type, self.op5.get_object_name(object_type, data_dict), data_dict)
+
+    def update(self, object_type, name, data):
+        return self.queue("PATCH", object_type, name, data)
+
+    def overwrite(self, object_type, name, data):
+        return self.queue("PUT", object_type, name, data)
+
+    def delete(self, object_type, name):
+        return self.queue("DELETE", object_type, name, None)
+
+    #returns the queued requests as (request_type, object_type, name, data) tuples, in the order they will be sent
+    def get_requests(self):
+        requests = [(change[0], key[0], key[1], change[1]) for key, change in self.changes.items()]
+        writes = sorted([r for r in requests if r[0] != "DELETE"], key=lambda r: get_dependency_tier(r[1]))
+        deletes = sorted([r for r in requests if r[0] == "DELETE"], key=lambda r: get_dependency_tier(r[1]), reverse=True)
+        return writes + deletes
+
+    #sends all queued requests and commits once. If any request or the commit fails, the changes are undone and False is returned
+    #with keep_going, failed requests are skipped and recorded in self.failed instead, and the other changes are committed
+    #in dryrun mode, all requests are only printed in order, and False is returned since nothing was changed
+    def flush(self, keep_going=False):
+        fname = sys._getframe().f_code.co_name
+        requests = self.get_requests()
+        self.changes.clear()
+        self.failed = []
+        if not requests:
+            return False
+        if self.op5.schema is not None: #check everything before sending anything
+            errors = self.op5.schema.validate_batch(requests)
+            if errors:
+                for index, error in errors:
+                    print colored("%s(): %s(%s) %s name: '%s'" % (fname, requests[index][0], requests[index][1], error, requests[index][2]), "red")
+                return False
+        if self.op5.dryrun: #operation() returns False for every write in dryrun mode, which is not a failure
+            for request_type, object_type, name, data in requests:
+                self.op5.operation(request_type, object_type, name if request_type != "POST" else "", data)
+            print colored("DRYRUN: %s(): would commit %d changes" % (fname, len(requests)), "yellow")
+            return False
+        for request_type, object_type, name, data in requests:
+            try:
+                if request_type == "POST":
+                    success = self.op5.operation(request_type, object_type, data=data)
+                else:
+                    success = self.op5.operation(request_type, object_type, name, data)
+            except Exception as e:
+                if not keep_going:
+                    self.op5.undo_changes()
+                    raise
+                print colored("%s(): %s(%s) raised %s. name: '%s'" % (fname, request_type, object_type, str(e), name), "red")
+                success = False
+            if not success:
+                if keep_going:
+                    print colored("%s(): %s(%s) failed, skipping it. name: '%s'" % (fname, request_type, object_type, name), "red")
+                    self.failed.append((object_type, name))
+                    continue
+                print colored("%s(): %s(%s) failed, undoing %d queued changes" % (fname, request_type, object_type, len(requests)), "red")
+                self.op5.undo_changes()
+                return False
+        if len(self.failed) == len(requests):
+            return False
+        try:
+            success = self.op5.commit_changes()
+        except Exception:
+            self.op5.undo_changes()
+            raise
+        if not success: #the changes must not be committed later by someone else
+            print colored("%s(): the commit failed, undoing %d changes" % (fname, len(requests) - len(self.failed)), "red")
+            self.op5.undo_changes()
+        return success
+
+class CheckResultQueue(object):
+    """
+    Submits passive check results through OP5.command_operation() from a background thread.
+    Results are sent when flush_size results are queued or flush_interval seconds have passed, max_workers at a time.
+    The queue holds at most max_size results. When it is full, a new result replaces the queued result of
+    the same host and service, and otherwise the caller blocks for up to timeout seconds (if block is set)
+    before the result is dropped.
+    """
+    def __init__(self, op5, max_size=10000, flush_size=500, flush_interval=5.0, block=True, timeout=None, max_workers=8):
+        self.op5 = op5
+        self.max_workers = max_workers
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.timeout = timeout
+        self.queue = deque() #of [key, command_type, data] entries
+        self.latest = {} #(host_name, service_description) -> the last queued entry for it
+        self.condition = threading.Condition()
+        self.counts = {"submitted": 0, "sent": 0, "coalesced": 0, "dropped": 0, "failed": 0}
+        self.in_flight = 0
+        self.flush_requested = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    #queues a check result. service_description None means a host check result
+    #RETURNS:
+    #True if the result was queued or replaced a queued result, False if it was dropped
+    def submit(self, host_name, service_description, status_code, plugin_output):
+        if service_description is None:
+            command_type = "PROCESS_HOST_CHECK_RESULT"
+            data = {"host_name": host_name, "status_code": status_code, "plugin_output": plugin_output}
+        else:
+            command_type = "PROCESS_SERVICE_CHECK_RESULT"
+            data = {"host_name": host_name, "service_description": service_description, "status_code": status_code, "plugin_output": plugin_output}
+        key = (host_name, service_description)
+
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The check result queue is closed")
+            self.counts["submitted"] += 1
+            if len(self.queue) >= self.max_size:
+                entry = self.latest.get(key)
+                if entry is not None: #only the latest result of a host or service is kept
+                    entry[2] = data
+                    self.counts["coalesced"] += 1
+                    return True
+                if self.block:
+                    deadline = None if self.timeout is None else time.time() + self.timeout
+                    while len(self.queue) >= self.max_size and not self.closed:
+                        if deadline is not None and time.time() >= deadline:
+                            break
+                        self.condition.wait(1 if deadline is None else min(1, deadline - time.time()))
+                if len(self.queue) >= self.max_size or self.closed:
+                    self.counts["dropped"] += 1
+                    return False
+            entry = [key, command_type, data]
+            self.queue.append(entry)
+            self.latest[key] = entry
+            if len(self.queue) >= self.flush_size:
+                self.condition.notify_all()
+        return True
+
+    def run(self):
+        last_flush = time.time()
+        while True:
+            with self.condition:
+                while not self.closed and not self.flush_requested and len(self.queue) < self.flush_size:
+                    remaining = last_flush + self.flush_interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if not self.queue:
+                    self.flush_requested = False
+                    last_flush = time.time()
+                    self.condition.notify_all()
+                    if self.closed:
+                        return
+                    continue
+                entries = [self.queue.popleft() for i in range(min(self.flush_size, len(self.queue)))]
+                for entry in entries:
+                    if self.latest.get(entry[0]) is entry:
+                        del self.latest[entry[0]]
+                self.in_flight = len(entries)
+                self.condition.notify_all() #there is room in the queue again
+
+            sent = failed = 0
+            for success in parallel_imap(self.send, entries, self.max_workers):
+                if success:
+                    sent += 1
+                else:
+                    failed += 1
+
+            with self.condition:
+                self.counts["sent"] += sent
+                self.counts["failed"] += failed
+                self.in_flight = 0
+                last_flush = time.time()
+                self.condition.notify_all()
+
+    def send(self, entry):
+        key, command_type, data = entry
+        try:
+            return self.op5.command_operation(command_type, data)
+        except Exception as e:
+            logger.error("%s: %s", command_type, e)
+            return False
+
+    #sends everything that is queued, and waits until it has been sent
+    def flush(self):
+        with self.condition:
+            self.flush_requested = True
+            self.condition.notify_all()
+            while self.queue or self.in_flight:
+                self.condition.wait(1)
+
+    #sends everything that is queued, and stops the background thread
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counts)
+            stats["pending"] = len(self.queue) + self.in_flight
+            return stats
+
+#a change seen by a StatusWatcher. type is "new", "state_change", "removed" or "resync". old and new are rows, or None
+WatchEvent = namedtuple("WatchEvent", ["type", "key", "old", "new"])
+
+class StatusWatcher(object):
+    """
+    Keeps an in-memory table of the rows of a /filter table, and reports what changed since the last poll.
+    A poll only asks for the rows whose last_check or last_state_change is newer than the previous poll.
+    Every resync_interval seconds all rows are fetched instead, which also finds removed objects and repairs drift.
+    """
+    KEY_COLUMNS = {"services": ["host_name","description"], "hosts": ["name"]}
+
+    def __init__(self, op5, table="services", query="all", columns=None, resync_interval=600, page_size=1000, overlap=2):
+        self.op5 = op5
+        self.table = table
+        self.query = query
+        self.key_columns = self.KEY_COLUMNS.get(table, ["name"])
+        if columns:
+            columns = list(columns) + [column for column in self.key_columns + ["state","last_check","last_state_change"] if column not in columns]
+        self.columns = columns
+        self.resync_interval = resync_interval
+        self.page_size = page_size
+        self.overlap = overlap #seconds subtracted from the time of the previous poll, in case the clocks of the client and the server differ
+        self.rows = {}
+        self.last_poll = None
+        self.last_resync = None
+
+    def get_key(self, row):
+        if len(self.key_columns) == 1:
+            return row.get(self.key_columns[0])
+        return tuple(row.get(column) for column in self.key_columns)
+
+    def get_filter_query(self, since=None):
+        query = "[%s] %s" % (self.table, self.query)
+        if since is None:
+            return query
+        changed = "(last_check >= %d or last_state_change >= %d)" % (since, since)
+        if self.query.strip() == "all":
+            return "[%s] %s" % (self.table, changed)
+        return "[%s] (%s) and %s" % (self.table, self.query, changed)
+
+    #RETURNS:
+    #a list of WatchEvents. The first poll reports every row as "new"
+    def poll(self, full=False):
+        start = time.time()
+        full = full or self.last_poll is None or start - self.last_resync >= self.resync_interval
+        since = None if full else self.last_poll - self.overlap
+        events = []
+        seen = set()
+        for row in self.op5.iter_filter(self.get_filter_query(since), self.columns, self.page_size):
+            key = self.get_key(row)
+            seen.add(key)
+            old = self.rows.get(key)
+            if old is None:
+                events.append(WatchEvent("new", key, None, row))
+            elif old.get("state") != row.get("state"):
+                events.append(WatchEvent("state_change", key, old, row))
+            elif full and old != row:
+                events.append(WatchEvent("resync", key, old, row)) #an update that incremental polls missed
+            self.rows[key] = row
+        if full:
+            for key in [row_key for row_key in self.rows if row_key not in seen]:
+                events.append(WatchEvent("removed", key, self.rows.pop(key), None))
+            self.last_resync = start
+        self.last_poll = start
+        return events
+
+    #polls every interval seconds, and yields the events
+    def watch(self, interval=30):
+        while True:
+            start = time.time()
+            for event in self.poll():
+                yield event
+            time.sleep(max(0, interval - (time.time() - start)))
+
+class BrokerClient(object):
+    """
+    Sends changes to an op5broker process over its Unix socket, instead of to the OP5 API.
+    The broker applies the changes of all its clients and commits them at most once per window.
+    Changes are queued by the broker right away. If wait is set, commit() waits until the broker has applied and committed
+    the changes sent through this client, and returns False if any of them failed.
+    """
+    def __init__(self, socket_path, wait=True, timeout=None):
+        self.socket_path = socket_path
+        self.wait = wait
+        self.timeout = timeout
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def call(self, message):
+        with self.lock:
+            for attempt in range(2): #reconnect once, in case the broker has been restarted
+                try:
+                    if self.connection is None:
+                        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        connection.settimeout(self.timeout)
+                        connection.connect(self.socket_path)
+                        self.connection = (connection, connection.makefile("rb"))
+                    self.connection[0].sendall(json.dumps(message) + "\n")
+                    line = self.connection[1].readline()
+                    if not line:
+                        raise socket.error("The broker closed the connection")
+                    return json.loads(line)
+                except socket.error:
+                    self.close_connection()
+                    if attempt == 1:
+                        raise
+
+    def close_connection(self):
+        if self.connection is not None:
+            self.connection[1].close()
+            self.connection[0].close()
+            self.connection = None
+
+    def submit(self, request_type, object_type, name, data):
+        response = self.call({"action": "submit", "request_type": request_type, "object_type": object_type, "name": name, "data": data})
+        if not response["success"] and "error" in response:
+            print colored("%s(%s): the broker refused the change: %s" % (request_type, object_type, response["error"]), "red")
+        return response["success"]
+
+    #asks the broker to commit as soon as its window allows
+    def commit(self):
+        response = self.call({"action": "commit", "wait": self.wait})
+        for object_type, name in response.get("failed", []):
+            print colored("%s(): the broker could not apply the change to %s '%s'" % (sys._getframe().f_code.co_name, object_type, name), "red")
+        return response["success"]
+
+    def stats(self):
+        return self.call({"action": "stats"})["stats"]
+
+#a hash of an object listing that does not depend on the order of the objects or their keys
+def get_listing_fingerprint(objects):
+    lines = sorted(json.dumps(dict(data), sort_keys=True) for data in objects)
+    return hashlib.sha1("\n".join(lines)).hexdigest()
+
+class ConfigSnapshot(object):
+    """
+    A copy of the /config objects on disk, written by OP5.export_snapshot().
+    Every object type has a file with one JSON object per line, and an index of object names to the position of their line.
+    The files are memory-mapped, and only the objects that are asked for are decoded.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.indexes = {}
+        self.maps = {}
+
+    def get_index(self, object_type):
+        if object_type not in self.indexes:
+            if object_type not in self.meta["object_types"]:
+                raise KeyError("Object type '%s' is not in the snapshot at %s" % (object_type, self.path))
+            with open(os.path.join(self.path, object_type + ".idx")) as f:
+                self.indexes[object_type] = json.load(f)
+        return self.indexes[object_type]
+
+    def get_map(self, object_type):
+        if object_type not in self.maps:
+            with open(os.path.join(self.path, object_type + ".jsonl"), "rb") as f:
+                self.maps[object_type] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[object_type]
+
+    def names(self, object_type):
+        return self.get_index(object_type).keys()
+
+    #returns the object, or None if it is not in the snapshot
+    def get(self, object_type, name):
+        position = self.get_index(object_type).get(name)
+        if position is None:
+            return None
+        offset, length = position
+        return json.loads(self.get_map(object_type)[offset:offset+length])
+
+    def iter_objects(self, object_type):
+        for name in self.get_index(object_type):
+            yield self.get(object_type, name)
+
+    def close(self):
+        for snapshot_map in self.maps.values():
+            snapshot_map.close()
+        self.maps = {}
+
+# The bundled schema: the types of common properties, and the properties that refer to other objects.
+# Properties that are not listed are accepted, unless the schema of the object type is "closed" (which learned schemas are).
+BUNDLED_SCHEMA = {
+    "host": {
+        "fields": {"host_name": "string", "alias": "string", "address": "string", "hostgroups": "list", "parents": "list",
+                   "contact_groups": "list", "contacts": "list", "template": "string", "check_command": "string", "check_command_args": "string",
+                   "check_period": "string", "notification_period": "string", "max_check_attempts": "integer", "check_interval": "number",
+                   "retry_interval": "number", "notes": "string", "register": "boolean"},
+        "references": {"hostgroups": "hostgroup", "parents": "host", "contact_groups": "contactgroup", "contacts": "contact",
+                       "template": "host_template", "check_command": "command", "check_period": "timeperiod", "notification_period": "timeperiod"},
+    },
+    "service": {
+        "fields": {"host_name": "string", "hostgroup_name": "string", "service_description": "string", "servicegroups": "list",
+                   "contact_groups": "list", "contacts": "list", "template": "string", "check_command": "string", "check_command_args": "string",
+                   "check_period": "string", "notification_period": "string", "max_check_attempts": "integer", "check_interval": "number",
+                   "retry_interval": "number", "notes": "string", "register": "boolean"},
+        "references": {"host_name": "host", "hostgroup_name": "hostgroup", "servicegroups": "servicegroup", "contact_groups": "contactgroup",
+                       "contacts": "contact", "template": "service_template", "check_command": "command", "check_period": "timeperiod",
+                       "notification_period": "timeperiod"},
+    },
+    "hostgroup": {
+        "fields": {"hostgroup_name": "string", "alias": "string", "members": "list", "hostgroup_members": "list", "notes": "string"},
+        "references": {"members": "host", "hostgroup_members": "hostgroup"},
+    },
+    "servicegroup": {
+        "fields": {"servicegroup_name": "string", "alias": "string", "members": "list", "notes": "string"},
+        "references": {},
+    },
+    "contact": {
+        "fields": {"contact_name": "string", "alias": "string", "email": "string", "pager": "string", "contactgroups": "list", "template": "string",
+                   "host_notification_period": "string", "service_notification_period": "string"},
+        "references": {"contactgroups": "contactgroup", "template": "contact_template", "host_notification_period": "timeperiod",
+                       "service_notification_period": "timeperiod"},
+    },
+    "contactgroup": {
+        "fields": {"contactgroup_name": "string", "alias": "string", "members": "list"},
+        "references": {"members": "contact"},
+    },
+    "command": {
+        "fields": {"command_name": "string", "command_line": "string"},
+        "references": {},
+    },
+    "timeperiod": {
+        "fields": {"timeperiod_name": "string", "alias": "string"},
+        "references": {},
+    },
+    "hostdependency": {
+        "fields": {"host_name": "string", "dependent_host_name": "string"},
+        "references": {"host_name": "host", "dependent_host_name": "host"},
+    },
+    "servicedependency": {
+        "fields": {"service": "string", "dependent_service": "string"},
+        "references": {"service": "service", "dependent_service": "service"},
+    },
+    "hostescalation": {
+        "fields": {"host_name": "string", "contact_groups": "list", "contacts": "list", "first_notification": "integer",
+                   "last_notification": "integer", "notification_interval": "number"},
+        "references": {"host_name": "host", "contact_groups": "contactgroup", "contacts": "contact"},
+    },
+}
+
+# Python types accepted for the type names used in schemas
+SCHEMA_TYPES = {
+    "string":  (basestring,),
+    "integer": (int, long),
+    "number":  (int, long, float),
+    "boolean": (bool, int),
+    "list":    (list,),
+    "object":  (dict,),
+}
+
+def get_schema_type(value):
+    if isinstance(value, bool):
+        return "boolean"
+    for type_name in ["string", "integer", "number", "list", "object"]:
+        if isinstance(value, SCHEMA_TYPES[type_name]):
+            return type_name
+    return "any"
+
+class SchemaValidator(object):
+    """
+    Checks changes locally before they are sent: required properties, property names and types, and references
+    to other objects. References are only checked for object types whose names are known, either from learn() or from add_names().
+    """
+    def __init__(self, spec=None):
+        self.spec = copy.deepcopy(BUNDLED_SCHEMA if spec is None else spec)
+        self.names = {} #object_type -> set of the names of existing objects
+        self.compiled = {}
+        for object_type in OBJECT_TYPES:
+            self.compile(object_type)
+
+    #precomputes what validate() needs for an object type
+    def compile(self, object_type):
+        spec = self.spec.setdefault(object_type, {"fields": {}, "references": {}})
+        fields = dict((field, SCHEMA_TYPES.get(type_name)) for field, type_name in spec.get("fields", {}).items())
+        required = get_required_properties(object_type)
+        for property in required: #required properties are always allowed, even if no learned object had them
+            for field in (property if isinstance(property, list) else [property]):
+                fields.setdefault(field, None)
+        self.compiled[object_type] = (required, fields, spec.get("references", {}), spec.get("closed", False))
+
+    #returns the schema, e.g. to save learned schemas as JSON
+    def dump(self):
+        return copy.deepcopy(self.spec)
+
+    def add_names(self, object_type, names):
+        self.names.setdefault(object_type, set()).update(names)
+
+    #Learns the property names and types of an object type from objects read from the server (e.g. a listing), and their names.
+    #If at least one full object was learned, the schema of the object type is closed afterwards, so unknown property names are errors.
+    #Entries that are only references to the objects are used for the names only.
+    def learn(self, object_type, objects):
+        spec = self.spec.setdefault(object_type, {"fields": {}, "references": {}})
+        fields = spec.setdefault("fields", {})
+        names = self.names.setdefault(object_type, set())
+        learned = False
+        for data in objects:
+            names.add(get_object_name(object_type, data) or data.get("name"))
+            if is_reference_only(data):
+                continue
+            learned = True
+            for field, value in data.items():
+                if value is None:
+                    continue
+                type_name = get_schema_type(value)
+                previous = fields.get(field)
+                if previous is None or previous == type_name:
+                    fields[field] = type_name
+                elif set([previous, type_name]) <= set(["integer", "number"]):
+                    fields[field] = "number"
+                elif set([previous, type_name]) <= set(["integer", "boolean"]):
+                    fields[field] = "integer"
+                else:
+                    fields[field] = "any"
+        if learned:
+            spec["closed"] = True
+        self.compile(object_type)
+
+    #keeps the names of existing objects in line with a change that the server accepted
+    def record(self, request_type, object_type, name, data):
+        if object_type not in self.names:
+            return
+        if request_type == "POST":
+            self.names[object_type].add(get_object_name(object_type, data))
+        elif request_type == "DELETE":
+            self.names[object_type].discard(name)
+
+    #learns the given object types with one listing read per object type
+    def learn_from_server(self, op5, object_types=None):
+        for object_type in object_types or OBJECT_TYPES:
+            if not op5.read(object_type, ""):
+                return False
+            self.learn(object_type, op5.data)
+        return True
+
+    def learn_from_snapshot(self, snapshot, object_types=None):
+        for object_type in object_types or snapshot.meta["object_types"].keys():
+            self.learn(object_type, snapshot.iter_objects(object_type))
+
+    #RETURNS:
+    #a list of error texts, which is empty if the change is valid
+    #names: the names to check references against, if not self.names
+    def validate(self, request_type, object_type, name, data, names=None):
+        if object_type not in self.compiled:
+            return ["Invalid object type '%s'" % object_type]
+        names = self.names if names is None else names
+        required, fields, references, closed = self.compiled[object_type]
+        errors = []
+        if request_type in ["PATCH","PUT","DELETE"] and object_type in names and name not in names[object_type]:
+            errors.append("%s '%s' does not exist" % (object_type, name))
+        if request_type == "DELETE" or not data:
+            return errors
+        if request_type in ["POST","PUT"]:
+            for property in required:
+                if isinstance(property, list):
+                    if not any(alternative in data for alternative in property):
+                        errors.append("Required property '%s' not set" % "' or '".join(property))
+                elif property not in data:
+                    errors.append("Required property '%s' not set" % property)
+        for field, value in data.items():
+            if field not in fields:
+                if closed:
+                    errors.append("Unknown property '%s'" % field)
+                continue
+            if value is not None and fields[field] is not None and not isinstance(value, fields[field]):
+                errors.append("Property '%s' has the wrong type (%s)" % (field, type(value).__name__))
+                continue
+            referenced_type = references.get(field)
+            if referenced_type is None or referenced_type not in names or not value:
+                continue
+            for referenced_name in (value if isinstance(value, list) else [value]):
+                if referenced_name not in names[referenced_type]:
+                    errors.append("Property '%s' refers to %s '%s' that does not exist" % (field, referenced_type, referenced_name))
+        return errors
+
+    #Validates a whole list of (request_type, object_type, name, data) changes in order, so that changes can refer to objects created earlier in the list
+    #RETURNS:
+    #a list of (index, error text) tuples
+    def validate_batch(self, requests):
+        names = dict((object_type, set(object_names)) for object_type, object_names in self.names.items())
+        errors = []
+        for index, (request_type, object_type, name, data) in enumerate(requests):
+            if request_type == "POST":
+                name = get_object_name(object_type, data or {})
+            errors.extend((index, error) for error in self.validate(request_type, object_type, name, data, names))
+            if object_type in names:
+                if request_type == "POST":
+                    names[object_type].add(name)
+                elif request_type == "DELETE":
+                    names[object_type].discard(name)
+        return errors
+
 class OP5(object):
 
-    def __init__(self, api_url, api_username, api_password, dryrun=False, debug=False, logtofile=False, interactive=False, max_retries=3, retry_wait=6, verify_certificates=True):
+    # methods that can be run concurrently through query_many()
+    READ_ONLY_METHODS = ["read","filter","report","get_group_members"]
+
+    def __init__(self, api_url, api_username, api_password, dryrun=False, debug=False, logtofile=False, interactive=False, max_retries=3, retry_wait=6, verify_certificates=True,
+                 pool_size=10, keep_alive=True, timeout=10, total_timeout=None, cache=False, cache_ttl=60, cache_size=10000,
+                 rate_limit=None, rate_burst=10, throttle=None, snapshot=None, broker=None, schema=None, compact=False):
         self.api_url = api_url
         self.api_username = api_username
         self.api_password = api_password
         self.dryrun = dryrun
         self.debug = debug
         self.interactive = interactive
+        self.local = threading.local() #the results of a call are kept per thread, so that concurrent calls do not overwrite each other
+        self.write_lock = threading.RLock() #mutating requests are sent one at a time
         self.data = []
         self.status_code = -1
         self.logtofile = logtofile
         self.max_retries = max_retries
-        self.retry_wait = retry_wait
+        self.retry_wait = retry_wait #the base of the exponential backoff between retries
+        self.throttle = throttle or Throttle(rate_limit, rate_burst, retry_wait) #pass the same Throttle to several OP5 objects to make them back off together
         self.modified = False
         self.verify_certificates = verify_certificates
+        self.timeout = timeout #seconds per HTTP request, either a number or a (connect, read) tuple
+        self.total_timeout = total_timeout #seconds for a whole call, including retries. None means no limit
+        self.session = self.create_session(pool_size, keep_alive)
+        self.cache = ConfigCache(cache_ttl, cache_size) if cache else None
+        self.stats = Stats()
+        self.snapshot = snapshot #in dryrun mode, reads are served from this ConfigSnapshot instead of the server
+        if isinstance(broker, basestring):
+            broker = BrokerClient(broker)
+        self.broker = broker #if set, changes are sent to an op5broker process, and reads still go to the server
+        self.schema = schema #if set, a SchemaValidator that checks every change before it is sent
+        self.compact = compact #if True, read(object_type, "") returns the objects in self.data as a CompactListing
+
+    @property
+    def data(self):
+        return getattr(self.local, "data", [])
+
+    @data.setter
+    def data(self, value):
+        self.local.data = value
+
+    @property
+    def status_code(self):
+        return getattr(self.local, "status_code", -1)
+
+    @status_code.setter
+    def status_code(self, value):
+        self.local.status_code = value
+
+    #one persistent session per OP5 object, so that TCP connections (and TLS sessions) are reused between calls
+    def create_session(self, pool_size, keep_alive):
+        session = requests.Session()
+        session.auth = (self.api_username, self.api_password)
+        session.verify = self.verify_certificates
+        session.headers.update({'content-type': 'application/json'})
+        if not keep_alive:
+            session.headers["Connection"] = "close"
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+
+    #returns how many HTTP requests have been sent, how many connections were opened for them, and how many requests reused an open connection
+    def connection_stats(self):
+        stats = {"requests": 0, "connections": 0}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats["requests"] += pool.num_requests
+                stats["connections"] += pool.num_connections
+        stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+        stats["reuse_ratio"] = float(stats["reused"]) / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+    def cache_stats(self):
+        if self.cache is None:
+            return {"hits": 0, "misses": 0, "size": 0}
+        return self.cache.stats()
+
+    #keeps the cache in line with a successful request
+    def update_cache(self, request_type, object_type, name, data):
+        if self.cache is None:
+            return
+        if object_type == "change":
+            if request_type == "DELETE": #undo_changes() reverts everything that is not committed
+                self.cache.clear()
+        elif request_type == "GET":
+            self.cache.set(object_type, name, self.status_code, self.data)
+        elif request_type == "POST":
+            self.cache.invalidate(object_type, self.get_object_name(object_type, data))
+        else:
+            self.cache.invalidate(object_type, name)
+
+    def get_timeout(self, deadline=None):
+        if deadline is None:
+            return self.timeout
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TotalTimeoutError("Bailing out since the total timeout of %s seconds has been exceeded" % self.total_timeout)
+        if isinstance(self.timeout, tuple):
+            return tuple(min(t, remaining) for t in self.timeout)
+        return min(self.timeout, remaining)
+
+    def get_deadline(self):
+        if self.total_timeout is None:
+            return None
+        return time.time() + self.total_timeout
+
+    def http_request(self, request_type, url, deadline=None, object_type="", **kwargs):
+        if request_type == "GET" or object_type == "command": #commands do not change the configuration, so they can be sent concurrently
+            return self.session.request(request_type, url, timeout=self.get_timeout(deadline), **kwargs)
+        with self.write_lock:
+            return self.session.request(request_type, url, timeout=self.get_timeout(deadline), **kwargs)
+
+    #500 "Export failed" with "nothing to do" is the answer to a commit without changes, and is not worth retrying
+    def is_nothing_to_do(self, r):
+        try:
+            json_obj = json.loads(r.text)
+            return json_obj['error'] == "Export failed" and json_obj['full_error']['type'] == "nothing to do"
+        except (ValueError, KeyError, TypeError):
+            return False
+
+    #sends a request through the throttle, and retries it with backoff while the status code is in retry_status_codes
+    #after max_retries attempts, the last response is returned
+    def send_request(self, request_type, url, deadline=None, retry_status_codes=(509,), object_type="", **kwargs):
+        attempt = 1
+        while True:
+            self.throttle.acquire(deadline)
+            start = time.time()
+            r = self.http_request(request_type, url, deadline, object_type, **kwargs)
+            self.stats.record_request(request_type, object_type, r.status_code, time.time() - start, r.elapsed.total_seconds(),
+                                      len(kwargs.get("data") or ""), len(r.content))
+            if r.status_code not in retry_status_codes or (r.status_code == 500 and self.is_nothing_to_do(r)):
+                self.throttle.success()
+                return r
+            if attempt >= self.max_retries:
+                return r
+            delay = self.throttle.backoff(r.status_code, attempt, parse_retry_after(r.headers.get("retry-after")))
+            self.stats.record_retry(request_type, object_type, r.status_code, delay)
+            if r.status_code == 509:
+                print colored("ERROR: OP5 internal sanity protections activated. Waiting %.1f seconds before trying again.." % delay, "red")
+            elif self.debug:
+                print "%s %s: got HTTP Status Code %d. Waiting %.1f seconds before trying again.." % (request_type, url, r.status_code, delay)
+            attempt += 1
+
+    #json.loads() of the response text, timed for the stats
+    def decode_response(self, r, request_type, object_type=""):
+        start = time.time()
+        try:
+            return json.loads(r.text)
+        finally:
+            self.stats.record_decode(request_type, object_type, time.time() - start)
+
+    #Runs many read-only calls concurrently, sharing the connection pool
+    #INPUTS:
+    #queries: list of tuples with a method name from READ_ONLY_METHODS and its arguments, e.g. ("read","host","myhost") or ("filter","query","[hosts] all")
+    #max_workers: number of threads
+    #RETURNS:
+    #a list of Result(success, status_code, data) tuples in the same order as queries, or False if a query is not read-only
+    def query_many(self, queries, max_workers=8):
+        fname = sys._getframe().f_code.co_name
+        queries = list(queries)
+        for query in queries:
+            if query[0] not in self.READ_ONLY_METHODS:
+                print colored("%s(): '%s' is not a read-only method! Valid methods: %s" % (fname, query[0], ", ".join(self.READ_ONLY_METHODS)), "red")
+                return False
+
+        def run_query(query):
+            self.status_code = -1 #so that a call that sends no request does not report the status of an earlier one
+            try:
+                value = getattr(self, query[0])(*query[1:])
+            except Exception as e:
+                return Result(False, self.status_code, str(e))
+            if query[0] == "get_group_members": #it returns [] if the group could not be read, so the read decides
+                return Result(value is not False and self.status_code == 200, self.status_code, value)
+            return Result(bool(value), self.status_code, self.data)
+
+        return parallel_map(run_query, queries, max_workers)
 
     def get_debug_text(self,request_type,object_type,name,data):
         #name will always be set except in the "create" case where everything is in "data"
@@ -72,9 +1391,104 @@ class OP5(object):
     def filter(self,api_type,query):
         return self.operation_querystring("/filter/"+api_type,query)
 
+    #Yields the rows of a /filter query page by page, so that memory use does not grow with the number of results
+    #INPUTS:
+    #query: string #e.g. "[services] state != 0"
+    #columns: list of column names to fetch, or None for all columns
+    #page_size: number of rows fetched per request, at least 1
+    #RETURNS:
+    #a generator of rows. RuntimeError is raised if a page can not be fetched, and ValueError if page_size is not positive
+    def iter_filter(self,query,columns=None,page_size=1000,api_type="query"):
+        if page_size < 1: #a page would never be shorter than page_size, so paging would never end
+            raise ValueError("page_size must be at least 1, not %s" % page_size)
+        url = self.api_url + "/filter/" + api_type
+        params = {"query": query.encode("UTF-8"), "limit": page_size}
+        if columns:
+            params["columns"] = ",".join(columns)
+
+        if self.debug or self.dryrun:
+            print "GET %s Query string: '%s' (%d rows per page)" % (url, query, page_size)
+        if self.dryrun:
+            return
+
+        offset = 0
+        while True:
+            params["offset"] = offset
+            r = self.send_request("GET", url, self.get_deadline(), object_type="filter/"+api_type, params=params)
+            if r.status_code != 200:
+                print colored("GET(/filter/%s): got HTTP Status Code %d %s. Query string: %s Offset: %d" % (api_type, r.status_code, r.reason, query, offset), "red")
+                if self.logtofile:
+                    logger.error("GET(/filter/%s): got HTTP Status Code %d %s. Query string: %s Offset: %d", api_type, r.status_code, r.reason, query, offset)
+                    logger.error("GET(/filter/%s): got HTTP Response: %s", api_type, r.text)
+                raise RuntimeError("GET(/filter/%s): got HTTP Status Code %d %s" % (api_type, r.status_code, r.reason))
+            page = self.decode_response(r, "GET", "filter/"+api_type)
+            del r
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                return
+            offset += page_size
+
     def report(self,query):
         return self.operation_querystring("/report/event",query)
 
+    #Fetches /report/event in time windows, up to max_workers windows at a time, and yields the events in chronological order
+    #INPUTS:
+    #start_time, end_time: unix timestamps
+    #query: dictionary of other query string parameters, e.g. {"host_name": "myhost"}
+    #window: length of a window in seconds. Windows start at multiples of window, so that the windows of overlapping time ranges are the same,
+    #and the first and last windows are clipped to start_time and end_time. start_time and end_time are inclusive, so windows end one second before the next one starts
+    #cache_dir: if set, whole windows that ended more than cache_delay seconds ago are stored there, and are read from disk by later calls.
+    #cache_delay should be longer than it takes for events to reach the report data
+    #RETURNS:
+    #a generator of events. RuntimeError is raised if a window can not be fetched
+    def iter_report(self,start_time,end_time,query=None,window=86400,max_workers=4,cache_dir=None,cache_delay=3600):
+        url = self.api_url + "/report/event"
+        start_time, end_time = int(start_time), int(end_time)
+        windows = [(max(t, start_time), min(t + window - 1, end_time)) for t in range(start_time - start_time % window, end_time + 1, window)]
+
+        if self.debug or self.dryrun:
+            print "GET %s Query string: '%s' (%d windows from %d to %d)" % (url, query, len(windows), start_time, end_time)
+        if self.dryrun:
+            return
+        if cache_dir and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError: #created by a concurrent call
+                if not os.path.isdir(cache_dir):
+                    raise
+
+        def fetch_window(time_window):
+            params = dict(query or {})
+            params["start_time"], params["end_time"] = time_window
+            cache_file = None
+            if cache_dir and time_window[1] - time_window[0] == window - 1 and time_window[1] < time.time() - cache_delay: #only whole windows, whose events are complete, are cached
+                key = json.dumps([self.api_url, sorted(params.items())])
+                cache_file = os.path.join(cache_dir, "report-%s.json" % hashlib.sha1(key).hexdigest())
+                if os.path.exists(cache_file):
+                    with open(cache_file) as f:
+                        return json.load(f)
+
+            r = self.send_request("GET", url, self.get_deadline(), object_type="report/event", params=params)
+            if r.status_code != 200:
+                print colored("GET(/report/event): got HTTP Status Code %d %s. Window: %d-%d" % (r.status_code, r.reason, time_window[0], time_window[1]), "red")
+                if self.logtofile:
+                    logger.error("GET(/report/event): got HTTP Status Code %d %s. Window: %d-%d", r.status_code, r.reason, time_window[0], time_window[1])
+                    logger.error("GET(/report/event): got HTTP Response: %s", r.text)
+                raise RuntimeError("GET(/report/event): got HTTP Status Code %d %s" % (r.status_code, r.reason))
+            events = self.decode_response(r, "GET", "report/event")
+
+            if cache_file:
+                fd, tmp_name = tempfile.mkstemp(dir=cache_dir) #write and rename, so that a concurrent reader never sees a partial file
+                with os.fdopen(fd, "w") as f:
+                    json.dump(events, f)
+                os.rename(tmp_name, cache_file)
+            return events
+
+        for events in parallel_imap(fetch_window, windows, max_workers):
+            for event in events:
+                yield event
+
     def create(self,object_type,data_dict):
         return self.operation("POST",object_type,data=data_dict)
 
@@ -94,8 +1508,24 @@ class OP5(object):
         return self.operation("GET","change")
 
     def undo_changes(self):
+        if self.broker is not None:
+            fname = sys._getframe().f_code.co_name
+            print colored("%s(): Changes sent to a broker can not be undone" % fname, "red")
+            return False
         return self.operation("DELETE","change")
 
+    #returns a ChangeBatch, that sends queued changes with a single commit
+    def batch(self):
+        return ChangeBatch(self)
+
+    #returns a StatusWatcher, that reports changes of a /filter table
+    def status_watcher(self, table="services", query="all", **kwargs):
+        return StatusWatcher(self, table, query, **kwargs)
+
+    #returns a CheckResultQueue, that submits passive check results from a background thread
+    def check_result_queue(self, **kwargs):
+        return CheckResultQueue(self, **kwargs)
+
     def commit_changes(self, force=False):
         fname = sys._getframe().f_code.co_name
         if not self.modified and not force:
@@ -103,9 +1533,21 @@ class OP5(object):
                 print colored("%s(): Not attempting commit since nothing has been modified" % fname, "yellow")
             return False
 
+        if self.broker is not None:
+            success = self.broker.commit()
+            if success:
+                self.modified = False
+            return success
+
         self.get_changes()
         if len(self.data) > 0: #there are changes to commit
-            return self.operation("POST","change")
+            start = time.time()
+            success = False
+            try:
+                success = self.operation("POST","change")
+            finally: #a commit that raises (e.g. after retrying "Export failed") is recorded as failed
+                self.stats.record_commit(time.time() - start, success)
+            return success
         else:
             print colored("%s(): Not attempting commit since nothing has been modified on the server" % fname, "red")
             return False
@@ -122,39 +1564,196 @@ class OP5(object):
             print colored("%s(): object_type '%s' is not valid" % (fname,object_type), "red")
             return False
 
+    #Returns the names of the objects that list group_name in their own group property, e.g. the hosts whose "hostgroups" contain it,
+    #with one listing read of the member object type. With compact=True, the index of the CompactListing is used, so with cache=True
+    #many groups can be looked up with one read. Members that are only set in the group's own "members" are not included, see get_group_members()
+    #RETURNS:
+    #a list of names, or False if the object type is not valid or the listing could not be read
+    def find_group_members(self,object_type,group_name):
+        if object_type not in GROUP_MEMBER_PROPERTIES:
+            fname = sys._getframe().f_code.co_name
+            print colored("%s(): object_type '%s' is not valid" % (fname,object_type), "red")
+            return False
+        member_type, key = GROUP_MEMBER_PROPERTIES[object_type]
+        if not self.read(member_type,""):
+            return False
+        if isinstance(self.data, CompactListing):
+            return self.data.find(key, group_name)
+        return [self.get_object_name(member_type,data) for data in self.data if group_name in (data.get(key) or [])]
+
+    #returns the name that the OP5 API uses for an object, or None if it can not be derived from the object's data
+    def get_object_name(self,object_type,data):
+        return get_object_name(object_type,data)
+
+    #returns the first key whose value differs between source and destination, or None if they match
+    def diff_object(self,data_at_source,data_at_destination):
+        for key in data_at_source:
+            if key not in data_at_destination:
+                return key
+            if type(data_at_destination[key]) is list and type(data_at_source[key]) is list:
+                if set(data_at_source[key]) != set(data_at_destination[key]): # using set() diffs here since order is not important
+                    return key
+            elif data_at_source[key] != data_at_destination[key]:
+                return key
+        return None
+
     def sync(self,object_type,name,data_at_source):
         if self.read(object_type,name): #get the information currently on the OP5 server
             data_at_destination=self.data
-            for key in data_at_source:
-                if (key not in data_at_destination
-                    or (type(data_at_destination[key]) is list and set(data_at_source[key]) != set(data_at_destination[key])) # if there is at least one diff, using set() diffs here since order is not important
-                    or data_at_source[key] != data_at_destination[key]):
-                    if self.debug:
-                        print "Data at source:",data_at_source
-                        print "Data at destination:",data_at_destination
-                    print key,":",data_at_source[key],"did not match", key,":",data_at_destination.get(key,None),"! Making an update request."
-                    return self.update(object_type,name,data_at_source) #send an update request
+            key = self.diff_object(data_at_source,data_at_destination)
+            if key is not None:
+                if self.debug:
+                    print "Data at source:",data_at_source
+                    print "Data at destination:",data_at_destination
+                print key,":",data_at_source[key],"did not match", key,":",data_at_destination.get(key,None),"! Making an update request."
+                return self.update(object_type,name,data_at_source) #send an update request
         else:
             return self.create(object_type,data_at_source)
 
+    #Syncs a whole set of objects of one object_type with a single listing read, instead of one read per object
+    #INPUTS:
+    #object_type: string #e.g. "host","hostgroup","service"
+    #desired_objects: iterable of dictionaries, in the same form as given to sync()
+    #delete_orphans: if True, objects on the server that are not in desired_objects are deleted
+    #RETURNS:
+    #a dictionary with the names that were "created", "updated", "deleted", "unchanged" and "failed", or False if the listing could not be read
+    def sync_many(self,object_type,desired_objects,delete_orphans=False):
+        fname = sys._getframe().f_code.co_name
+        desired = {}
+        for data_at_source in desired_objects:
+            name = self.get_object_name(object_type,data_at_source)
+            if name is None:
+                print colored("%s(%s): Can not determine the name of the object! data: %s" % (fname, object_type, str(data_at_source)), "red")
+                return False
+            desired[name] = data_at_source
+
+        if not self.read(object_type,""):
+            return False
+        current = {}
+        for data_at_destination in self.data:
+            if is_reference_only(data_at_destination): #only a reference to the object was listed
+                current[data_at_destination["name"]] = None
+            else:
+                current[self.get_object_name(object_type,data_at_destination) or data_at_destination.get("name")] = data_at_destination
+
+        summary = {"created": [], "updated": [], "deleted": [], "unchanged": [], "failed": []}
+        for name, data_at_source in desired.items():
+            if name not in current:
+                success = self.create(object_type,data_at_source)
+                summary["created" if success else "failed"].append(name)
+                continue
+            data_at_destination = current[name]
+            if data_at_destination is None: #fall back to reading the full object
+                if not self.read(object_type,name):
+                    summary["failed"].append(name)
+                    continue
+                data_at_destination = self.data
+            if self.diff_object(data_at_source,data_at_destination) is None:
+                summary["unchanged"].append(name)
+            elif self.update(object_type,name,data_at_source):
+                summary["updated"].append(name)
+            else:
+                summary["failed"].append(name)
+
+        if delete_orphans:
+            for name in current:
+                if name not in desired:
+                    success = self.delete(object_type,name)
+                    summary["deleted" if success else "failed"].append(name)
+
+        if self.debug:
+            print "%s(%s): %s" % (fname, object_type, ", ".join("%d %s" % (len(names), key) for key, names in sorted(summary.items())))
+        return summary
+
+    #Writes all objects of the given object types to a ConfigSnapshot at path, with one listing read per object type
+    #RETURNS:
+    #the ConfigSnapshot, or False if a listing could not be read
+    def export_snapshot(self,path,object_types=None):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        meta = {"api_url": self.api_url, "created": time.time(), "object_types": {}}
+        for object_type in object_types or OBJECT_TYPES:
+            if not self.operation("GET",object_type,"",use_cache=False):
+                return False
+            listing = self.data
+            index = {}
+            with open(os.path.join(path, object_type + ".jsonl"), "wb") as f:
+                for data in listing:
+                    if is_reference_only(data): #only a reference to the object was listed, so the full object is read
+                        if not self.operation("GET",object_type,data["name"],use_cache=False):
+                            return False
+                        data = self.data
+                    line = json.dumps(dict(data))
+                    index[self.get_object_name(object_type,data) or data.get("name")] = [f.tell(), len(line)]
+                    f.write(line + "\n")
+            with open(os.path.join(path, object_type + ".idx"), "w") as f:
+                json.dump(index, f)
+            meta["object_types"][object_type] = {"count": len(index), "fingerprint": get_listing_fingerprint(listing)}
+            self.data = []
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return ConfigSnapshot(path)
+
+    #Computes the changes that sync_many() would make, against a ConfigSnapshot instead of the server. Nothing is sent to the server.
+    #RETURNS:
+    #a dictionary with the "object_type", the objects to "create", the (name, data) tuples to "update", and the names to "delete" and that are "unchanged"
+    #or False if the name of an object can not be determined
+    def plan(self,snapshot,object_type,desired_objects,delete_orphans=False):
+        fname = sys._getframe().f_code.co_name
+        plan = {"object_type": object_type, "create": [], "update": [], "delete": [], "unchanged": []}
+        desired_names = set()
+        for data_at_source in desired_objects:
+            name = self.get_object_name(object_type,data_at_source)
+            if name is None:
+                print colored("%s(%s): Can not determine the name of the object! data: %s" % (fname, object_type, str(data_at_source)), "red")
+                return False
+            desired_names.add(name)
+            data_at_destination = snapshot.get(object_type,name)
+            if data_at_destination is not None and is_reference_only(data_at_destination):
+                print colored("%s(%s): The snapshot at %s only has a reference to '%s'. Export it again to plan against it." % (fname, object_type, snapshot.path, name), "red")
+                return False
+            if data_at_destination is None:
+                plan["create"].append(data_at_source)
+            elif self.diff_object(data_at_source,data_at_destination) is None:
+                plan["unchanged"].append(name)
+            else:
+                plan["update"].append((name,data_at_source))
+        if delete_orphans:
+            plan["delete"] = [orphan for orphan in snapshot.names(object_type) if orphan not in desired_names]
+        return plan
+
+    #Checks that the objects of the given types on the server still match the snapshot, with one listing read per object type
+    def verify_snapshot(self,snapshot,object_types):
+        fname = sys._getframe().f_code.co_name
+        for object_type in object_types:
+            if not self.operation("GET",object_type,"",use_cache=False): #the server, and not the cache, has to match the snapshot
+                return False
+            fingerprint = get_listing_fingerprint(self.data)
+            self.data = []
+            if fingerprint != snapshot.meta["object_types"][object_type]["fingerprint"]:
+                print colored("%s(%s): The server has changed since the snapshot at %s was taken" % (fname, object_type, snapshot.path), "red")
+                return False
+        return True
+
+    #Applies one or more plans made by plan() in a single ChangeBatch, after verifying that the snapshot they were made against is still fresh
+    def apply_plan(self,snapshot,plans):
+        if isinstance(plans, dict):
+            plans = [plans]
+        if not self.verify_snapshot(snapshot, set(plan["object_type"] for plan in plans)):
+            return False
+        batch = self.batch()
+        for plan in plans:
+            for data in plan["create"]:
+                batch.create(plan["object_type"],data)
+            for name, data in plan["update"]:
+                batch.update(plan["object_type"],name,data)
+            for name in plan["delete"]:
+                batch.delete(plan["object_type"],name)
+        return batch.flush()
+
     # Function to check that all required object properties are set
     def validate_object(self,request_type,object_type,data):
-        # Sublists denote that either of the values need to be present, but not both
-        required_properties = {}
-        required_properties["command"]           = ["command_line", "command_name"];
-        required_properties["contact"]           = ["alias", "contact_name"];
-        required_properties["default"]           = [["name", object_type+"_name"]];
-        required_properties["graph_template"]    = ["check"];
-        required_properties["hostdependency"]    = ["dependent_host_name", "host_name"];
-        required_properties["hostescalation"]    = ["first_notification", "host_name", "last_notification", "notification_interval"];
-        required_properties["service"]           = [["host_name", "hostgroup_name"], "service_description"];
-        required_properties["servicedependency"] = ["dependent_service", "service"];
-        required_properties["user"]              = ["username", "password"];
-
-        if object_type in required_properties:
-            required_properties_list = required_properties[object_type]
-        else:
-            required_properties_list = required_properties["default"]
+        required_properties_list = get_required_properties(object_type)
 
         validation_passed = True # "passed" by default
 
@@ -177,16 +1776,13 @@ class OP5(object):
 
         return True
 
-    def validate_request(self,request_type,object_type,name,data):
+    def validate_request(self,request_type,object_type,name,data,use_schema=True):
         if request_type not in ["GET","POST","PATCH","PUT","DELETE"]:
             print colored("%s(%s): Invalid request type! name:'%s' data: %s" % (request_type, object_type, name, str(data) ), "red")
             return False
 
         if object_type != "change":
-            valid_object_types = ["host","hostgroup","service","servicegroup","contact","contactgroup","host_template","service_template",
-                                  "contact_template","hostdependency","servicedependency","hostescalation","serviceescalation","user","usergroup",
-                                  "combined_graph","graph_collection","graph_template","management_pack","timeperiod","command"]
-            if object_type not in valid_object_types:
+            if object_type not in OBJECT_TYPES:
                 print colored("%s(%s): Invalid object type! name:'%s' data: %s" % (request_type, object_type, name, str(data) ), "red")
                 return False
 
@@ -203,10 +1799,16 @@ class OP5(object):
                 # Return False if False, otherwise continue
                 if not self.validate_object(request_type, object_type, data):
                     return False
+            if use_schema and self.schema is not None and request_type != "GET":
+                errors = self.schema.validate(request_type, object_type, name, data)
+                if errors:
+                    for error in errors:
+                        print colored("%s(%s): %s name:'%s'" % (request_type, object_type, error, name), "red")
+                    return False
 
         return True
 
-    def command_operation(self, command_type, data, rdepth=0):
+    def command_operation(self, command_type, data):
         url = self.api_url + "/command/" + command_type
 
         if self.debug or self.dryrun:
@@ -216,10 +1818,10 @@ class OP5(object):
         if self.dryrun:
             return False
 
-        http_headers = {'content-type': 'application/json'}
-
         try:
-            r = requests.post(url, auth=(self.api_username, self.api_password), data=json.dumps(data), headers=http_headers, timeout=10, verify=self.verify_certificates)
+            r = self.send_request("POST", url, self.get_deadline(), object_type="command", data=json.dumps(data))
+        except TotalTimeoutError:
+            raise
         except Exception as e:
             self.data = str(e)
             import pprint; pprint.pprint(e)
@@ -231,12 +1833,11 @@ class OP5(object):
             print r.headers
 
         try:
-            self.data = json.loads(r.text)
+            self.data = self.decode_response(r, "POST", "command")
         except ValueError as e:
             self.data = r.text
             if r.status_code == 509:
-              print colored("ERROR: OP5 internal sanity protections activated. Please wait for a while and try again..","red")
-              return
+                raise RuntimeError("Bailing out after %d retries on HTTP 509 OP5 Sanity Protection Error" % self.max_retries)
             if r.headers["content-type"].find("text/html") != -1:
                 raise e
         self.status_code = r.status_code
@@ -246,18 +1847,18 @@ class OP5(object):
             print colored("POST(command/%s): got HTTP Status Code %d %s. Sent data: %s" % (command_type, r.status_code, r.reason, str(data)), "red")
             print colored("POST(command/%s): got HTTP Response: %s" % (command_type, r.text), "red")
             if self.logtofile:
-                logger.error("POST(command/%s): got HTTP Status Code %d %s. Sent data: %s" % (command_type, r.status_code, r.reason, str(data)))
-                logger.error("POST(command/%s): got HTTP Response: %s" % (command_type, r.text))
-                logger.debug("POST(command/%s): HTTP Response headers were: %s" % (command_type, r.headers) )
+                logger.error("POST(command/%s): got HTTP Status Code %d %s. Sent data: %s", command_type, r.status_code, r.reason, data)
+                logger.error("POST(command/%s): got HTTP Response: %s", command_type, r.text)
+                logger.debug("POST(command/%s): HTTP Response headers were: %s", command_type, r.headers)
             return False
 
         if not self.interactive: #in interactive mode, skip the status text for successful requests, so that the JSON output can easily be piped into another command
             print colored("POST(command/%s): Sent data: '%s'" % (command_type, str(data)), "green")
         if self.logtofile:
-            logger.info("POST(command/%s): Sent data: '%s'" % (command_type, str(data)))
+            logger.info("POST(command/%s): Sent data: '%s'", command_type, data)
         return True
 
-    def operation_querystring(self, api_type, query, rdepth=0):
+    def operation_querystring(self, api_type, query):
         url = self.api_url + api_type
         if api_type.startswith("/filter"):
             query = "query="+query
@@ -269,10 +1870,10 @@ class OP5(object):
         if self.dryrun:
             return False
 
-        http_headers = {'content-type': 'application/json'}
-
         try:
-            r = requests.get(url, auth=(self.api_username, self.api_password), params=query.encode("UTF-8"), headers=http_headers, timeout=10, verify=self.verify_certificates)
+            r = self.send_request("GET", url, self.get_deadline(), object_type=api_type.lstrip("/"), params=query.encode("UTF-8"))
+        except TotalTimeoutError:
+            raise
         except Exception as e:
             self.data = str(e)
             import pprint; pprint.pprint(e)
@@ -284,12 +1885,11 @@ class OP5(object):
             print r.headers
 
         try:
-            self.data = json.loads(r.text)
+            self.data = self.decode_response(r, "GET", api_type.lstrip("/"))
         except ValueError as e:
             self.data = r.text
             if r.status_code == 509:
-              print colored("ERROR: OP5 internal sanity protections activated. Please wait for a while and try again..","red")
-              return
+                raise RuntimeError("Bailing out after %d retries on HTTP 509 OP5 Sanity Protection Error" % self.max_retries)
             #GET can return HTTP 200 OK with "index mismatch", but in any other non-success scenario, we should be receiving JSON, and not HTML
             if r.text.find("index mismatch") != -1 or (r.status_code not in [200,201] and r.headers["content-type"].find("text/html") != -1):
                 raise e
@@ -300,15 +1900,15 @@ class OP5(object):
             print colored("GET(%s): got HTTP Status Code %d %s. Query string: %s" % (api_type, r.status_code, r.reason, query), "red")
             print colored("GET(%s): got HTTP Response: %s" % (api_type, r.text), "red")
             if self.logtofile:
-                logger.error("GET(%s): got HTTP Status Code %d %s. Query string: %s" % (api_type, r.status_code, r.reason, query))
-                logger.error("GET(%s): got HTTP Response: %s" % (api_type, r.text))
-                logger.debug("GET(%s): HTTP Response headers were: %s" % (api_type, r.headers) )
+                logger.error("GET(%s): got HTTP Status Code %d %s. Query string: %s", api_type, r.status_code, r.reason, query)
+                logger.error("GET(%s): got HTTP Response: %s", api_type, r.text)
+                logger.debug("GET(%s): HTTP Response headers were: %s", api_type, r.headers)
             return False
 
         if not self.interactive: #in interactive mode, skip the status text for successful requests, so that the JSON output can easily be piped into another command
             print colored("GET(%s): Query string: '%s'" % (api_type, query), "green")
         if self.logtofile:
-            logger.info("GET(%s): Query string: '%s'" % (api_type, query))
+            logger.info("GET(%s): Query string: '%s'", api_type, query)
         return True
 
     #CRUD: create, read, update, delete [, and overwrite]
@@ -320,12 +1920,45 @@ class OP5(object):
     #boolean indicating success/failure of operation
     #the response JSON text is loaded into a JSON object and put into self.data
     #the http status code is put into self.status_code
-    def operation(self,request_type,object_type,name="",data=None,rdepth=0):
+    #use_cache: if False, a GET is always sent to the server (and its result still updates the cache)
+    def operation(self,request_type,object_type,name="",data=None,use_cache=True):
         url = self.api_url + "/config/" + object_type
+        deadline = self.get_deadline()
 
         if not self.validate_request(request_type,object_type,name,data):
             return False
 
+        if self.broker is not None and request_type != "GET" and object_type != "change":
+            if self.dryrun:
+                print colored("DRYRUN: "+self.get_debug_text(request_type,object_type,name,data), "yellow")
+                return False
+            if not self.broker.submit(request_type,object_type,name,data):
+                return False
+            if not self.interactive:
+                print colored("BROKER: "+self.get_debug_text(request_type,object_type,name,data), "green")
+            if self.cache is not None:
+                self.cache.invalidate(object_type, self.get_object_name(object_type,data) if request_type == "POST" else name)
+            self.modified = True
+            return True
+
+        cache_name = name
+        if request_type == "GET" and self.dryrun and self.snapshot is not None and object_type in self.snapshot.meta["object_types"]: #other object types are read from the server
+            if name == "":
+                self.data = list(self.snapshot.iter_objects(object_type))
+            else:
+                self.data = self.snapshot.get(object_type, name)
+            self.status_code = 404 if self.data is None else 200
+            if self.debug:
+                print "DRYRUN: %s(%s) served from the snapshot at %s. name: '%s'" % (request_type, object_type, self.snapshot.path, name)
+            return self.status_code == 200
+        if request_type == "GET" and object_type != "change" and self.cache is not None and use_cache:
+            cached = self.cache.get(object_type, name)
+            if cached is not None:
+                self.status_code, self.data = cached
+                if self.debug:
+                    print "%s(%s): served from cache. name: '%s'" % (request_type, object_type, name)
+                return self.status_code == 200
+
         # a little extra code here to fix the service name when referring to a hostgroup in the URL
         if (request_type in ["PATCH","PUT","DELETE"] or (request_type == "GET" and name != "")) and object_type == "service" and self.debug:
             print "INFO: Checking if the given name is a hostgroup first."
@@ -344,10 +1977,10 @@ class OP5(object):
             print colored("DRYRUN: "+self.get_debug_text(request_type,object_type,name,data), "yellow")
             return False
 
-        http_headers={'content-type': 'application/json'}
-
         try:
-            r = getattr(requests,request_type.lower()) (url,auth=(self.api_username, self.api_password), data=json.dumps(data), headers=http_headers, timeout=10, verify=self.verify_certificates)
+            r = self.send_request(request_type, url, deadline, retry_status_codes=(509,500), object_type=object_type, data=json.dumps(data))
+        except TotalTimeoutError:
+            raise
         except Exception as e:
             self.data = str(e)
             import pprint; pprint.pprint(e)
@@ -359,17 +1992,11 @@ class OP5(object):
             print r.headers
 
         try:
-            self.data = json.loads(r.text)
+            self.data = self.decode_response(r, request_type, object_type)
         except ValueError as e:
             self.data = r.text
             if r.status_code == 509:
-              rdepth+=1
-              if rdepth < self.max_retries:
-                  print colored("ERROR: OP5 internal sanity protections activated. Waiting for a while before trying again..","red")
-                  time.sleep(self.retry_wait)
-                  return self.operation(request_type,object_type,name,data,rdepth)
-              else:
-                  raise RuntimeError("Bailing out after 3 retries on HTTP 509 OP5 Sanity Protection Error")
+                raise RuntimeError("Bailing out after %d retries on HTTP 509 OP5 Sanity Protection Error" % self.max_retries)
             #GET can return HTTP 200 OK with "index mismatch", but in any other non-success scenario, we should be receiving JSON, and not HTML
             if r.text.find("index mismatch") != -1 or (r.status_code not in [200,201] and r.headers["content-type"].find("text/html") != -1):
                 raise e
@@ -381,20 +2008,16 @@ class OP5(object):
             print colored("%s(%s): got HTTP Status Code %d %s. Name: '%s'. Sent data: %s" % (request_type, object_type, r.status_code, r.reason, name, str(data)), "red")
             print colored("%s(%s): got HTTP Response: %s" % (request_type, object_type, r.text), "red")
             if self.logtofile:
-                logger.error("%s(%s): got HTTP Status Code %d %s. Name: '%s'. Sent data: %s" % (request_type, object_type, r.status_code, r.reason, name, str(data)) )
-                logger.error("%s(%s): got HTTP Response: %s" % (request_type, object_type, r.text) )
-                logger.debug("%s(%s): HTTP Response headers were: %s" % (request_type, object_type, r.headers) )
+                logger.error("%s(%s): got HTTP Status Code %d %s. Name: '%s'. Sent data: %s", request_type, object_type, r.status_code, r.reason, name, data)
+                logger.error("%s(%s): got HTTP Response: %s", request_type, object_type, r.text)
+                logger.debug("%s(%s): HTTP Response headers were: %s", request_type, object_type, r.headers)
+            if request_type == "GET" and r.status_code == 404:
+                self.update_cache(request_type, object_type, cache_name, data) #remember that the object does not exist
             return False
-        elif r.status_code == 500: #500 Internal Error
-            rdepth+=1
-            if rdepth < self.max_retries:
-                json_obj = json.loads(r.text)
-                if json_obj['error'] == "Export failed" and json_obj['full_error']['type'] == "nothing to do":
-                    return False
-                time.sleep(self.retry_wait)
-                return self.operation(request_type,object_type,name,data,rdepth)
-            else:
-                raise RuntimeError("Bailing out after 3 retries on HTTP 500 Internal Error")
+        elif r.status_code == 500: #500 Internal Error, which send_request() has already retried
+            if self.is_nothing_to_do(r):
+                return False
+            raise RuntimeError("Bailing out after %d retries on HTTP 500 Internal Error" % self.max_retries)
 
         #success! #200 OK, 201 Created
 
@@ -403,10 +2026,92 @@ class OP5(object):
             print colored(self.get_debug_text(request_type,object_type,name,data), "green")
         #log (successful) changes
         if request_type != "GET" and self.logtofile:
-            logger.info(self.get_debug_text(request_type,object_type,name,data))
+            logger.info("%s", DebugText(self,request_type,object_type,name,data))
 
+        if self.compact and request_type == "GET" and name == "" and object_type in OBJECT_TYPES and isinstance(self.data, list):
+            self.data = CompactListing(object_type, self.data)
+        self.update_cache(request_type, object_type, cache_name, data)
+        if self.schema is not None and request_type != "GET":
+            self.schema.record(request_type, object_type, cache_name, data)
         if request_type != "GET" and object_type != "change": #if it is not a "read" request or a "commit" request
             self.modified = True
         elif object_type == "change" and (request_type in ["POST","DELETE"] or (request_type == "GET" and len(self.data) == 0)):
             self.modified = False #reset the modified flag after a successful commit, or after understanding that there is nothing to commit
         return True
+
+class OP5Fleet(object):
+    """
+    Runs the same calls on several OP5 objects (e.g. masters and peers) in parallel, with at most
+    per_instance_limit calls at a time per instance, and gathers the results and errors of every instance.
+    If stop_on_error is set, calls that have not started yet are skipped after the first failure.
+    """
+    def __init__(self, instances, max_workers=8, per_instance_limit=2, stop_on_error=False):
+        if not isinstance(instances, dict):
+            instances = OrderedDict((instance.api_url, instance) for instance in instances)
+        self.instances = instances
+        self.max_workers = max_workers
+        self.stop_on_error = stop_on_error
+        self.limits = dict((name, threading.Semaphore(per_instance_limit)) for name in instances)
+
+    #Runs getattr(instance, method)(*args) for every instance and every args tuple in calls
+    #RETURNS:
+    #a dictionary of instance name -> list of Result(success, status_code, data) tuples, in the same order as calls
+    #data is the return value for methods that return data (e.g. get_group_members), and otherwise the data of the response (or the error text)
+    def map(self, method, calls):
+        calls = list(calls)
+        failed = threading.Event()
+
+        def run_call(task):
+            name, args = task
+            instance = self.instances[name]
+            with self.limits[name]:
+                if self.stop_on_error and failed.is_set():
+                    return Result(False, -1, "Skipped after an earlier failure")
+                try:
+                    value = getattr(instance, method)(*args)
+                except Exception as e:
+                    failed.set()
+                    return Result(False, instance.status_code, str(e))
+            if value is False:
+                failed.set()
+            if isinstance(value, bool) or value is None:
+                return Result(value is not False, instance.status_code, instance.data)
+            return Result(True, instance.status_code, value)
+
+        tasks = [(name, args) for args in calls for name in self.instances] #interleaved, so that all instances start right away
+        results = OrderedDict((name, []) for name in self.instances)
+        for (name, args), result in zip(tasks, parallel_map(run_call, tasks, self.max_workers)):
+            results[name].append(result)
+        return results
+
+    #Runs one call on every instance
+    #RETURNS:
+    #a dictionary of instance name -> Result(success, status_code, data)
+    def call(self, method, *args):
+        return OrderedDict((name, results[0]) for name, results in self.map(method, [args]).items())
+
+    #returns the names of the instances whose Result was not successful
+    def failures(self, results):
+        return [name for name, result in results.items() if not all(r.success for r in (result if isinstance(result, list) else [result]))]
+
+    def read(self, object_type, name):
+        return self.call("read", object_type, name)
+
+    def filter(self, api_type, query):
+        return self.call("filter", api_type, query)
+
+    def sync(self, object_type, name, data_at_source):
+        return self.call("sync", object_type, name, data_at_source)
+
+    def sync_many(self, object_type, desired_objects, delete_orphans=False):
+        return self.call("sync_many", object_type, list(desired_objects), delete_orphans)
+
+    def command(self, command_type, query):
+        return self.call("command", command_type, query)
+
+    def commit_changes(self, force=False):
+        return self.call("commit_changes", force)
+
+    def close(self):
+        for instance in self.instances.values():
+            instance.close()
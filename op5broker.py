@@ -0,0 +1,234 @@
+import SocketServer
+import threading
+import logging
+import json
+import time
+import sys
+import os
+
+import op5
+
+# A local process that owns the only API session towards OP5. Nodes send their changes to it over a Unix socket
+# (e.g. with OP5(..., broker="/run/op5broker.sock")), and it applies them and commits at most once per window,
+# so that many nodes coming up at the same time cause one export instead of one each.
+
+logger = logging.getLogger("op5broker")
+logger.addHandler(op5.NullHandler())
+
+class Generation(object):
+    """
+    The changes that are applied and committed together, so that waiting clients can get the result.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = set() #(object_type, name) of the changes that could not be applied
+
+    #returns True if the change was applied and committed. Changes without a name fail if any change failed
+    def succeeded(self, object_type, name):
+        if not self.result:
+            return False
+        if name is None:
+            return not self.failed
+        return (object_type, name) not in self.failed
+
+class BrokerHandler(SocketServer.StreamRequestHandler):
+    #one JSON message per line, and one JSON response line for each
+    def handle(self):
+        submitted = [] #(generation, object_type, name) of the changes sent over this connection, until the next commit
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                response = self.server.broker.handle_message(json.loads(line), submitted)
+            except Exception as e:
+                logger.exception("Could not handle message: %s", line.strip())
+                response = {"success": False, "error": str(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class BrokerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class CommitBroker(object):
+    """
+    Queues the changes of all clients in a ChangeBatch, and flushes it (which commits once) commit_window seconds
+    after the first change was queued, but no sooner than commit_window seconds after the previous commit.
+    A change that fails is skipped, so that it does not undo the changes of other clients, and is reported to the
+    client that sent it when that client commits with wait.
+    """
+    def __init__(self, op5_client, socket_path, commit_window=60):
+        self.op5 = op5_client
+        self.socket_path = socket_path
+        self.commit_window = commit_window
+        self.condition = threading.Condition()
+        self.batch = self.op5.batch()
+        self.generation = Generation()
+        self.last_commit = 0
+        self.first_queued = None
+        self.commit_requested = False
+        self.stopped = False
+        self.counts = {"submitted": 0, "refused": 0, "failed": 0, "commits": 0, "failed_commits": 0}
+        self.server = None
+        self.thread = None
+
+    #submitted: the list of changes sent over the same connection, which is kept by the caller
+    def handle_message(self, message, submitted=None):
+        submitted = [] if submitted is None else submitted
+        action = message.get("action")
+        if action == "stats":
+            return {"success": True, "stats": self.stats()}
+        if action not in ["submit", "commit"]:
+            return {"success": False, "error": "Unknown action: %s" % action}
+
+        with self.condition:
+            if self.stopped:
+                return {"success": False, "error": "The broker is stopping"}
+            if action == "submit":
+                request_type, object_type, name, data = message["request_type"], message["object_type"], message.get("name"), message.get("data")
+                if request_type == "POST":
+                    success = self.batch.create(object_type, data)
+                elif request_type == "PATCH":
+                    success = self.batch.update(object_type, name, data)
+                elif request_type == "PUT":
+                    success = self.batch.overwrite(object_type, name, data)
+                elif request_type == "DELETE":
+                    success = self.batch.delete(object_type, name)
+                else:
+                    success = False
+                if not success:
+                    self.counts["refused"] += 1
+                    return {"success": False, "error": "Invalid or conflicting %s(%s) name: '%s'" % (request_type, object_type, name)}
+                self.counts["submitted"] += 1
+                if self.first_queued is None:
+                    self.first_queued = time.time()
+                if request_type == "POST":
+                    name = op5.get_object_name(object_type, data)
+                submitted.append((self.generation, object_type, name))
+            else:
+                self.commit_requested = True
+            generation = self.generation
+            self.condition.notify_all()
+
+        if action == "submit":
+            if message.get("wait"):
+                generation.done.wait()
+                return {"success": generation.succeeded(object_type, name)}
+            return {"success": True}
+        if not message.get("wait"):
+            submitted[:] = [change for change in submitted if not change[0].done.is_set()]
+            return {"success": True}
+        if not submitted: #nothing was sent over this connection, so the result is that of the next commit
+            generation.done.wait()
+            return {"success": bool(generation.result)}
+        for change_generation, object_type, name in submitted:
+            change_generation.done.wait()
+        failed = [[object_type, name] for change_generation, object_type, name in submitted if not change_generation.succeeded(object_type, name)]
+        del submitted[:]
+        return {"success": not failed, "failed": failed}
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    if len(self.batch) > 0:
+                        remaining = max(self.last_commit, self.first_queued) + self.commit_window - time.time()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    else:
+                        if self.commit_requested: #nothing to apply, so waiting clients can be answered right away
+                            self.finish_generation(False)
+                        self.condition.wait(1)
+                if self.stopped and len(self.batch) == 0:
+                    self.finish_generation(False)
+                    return
+                batch, generation = self.batch, self.generation
+                self.batch, self.generation = self.op5.batch(), Generation()
+                self.commit_requested = False
+                self.first_queued = None
+
+            logger.info("Applying %d changes", len(batch))
+            try:
+                result = batch.flush(keep_going=True)
+            except Exception:
+                logger.exception("Applying the changes failed")
+                result = False
+            for object_type, name in batch.failed:
+                logger.error("Could not apply the change to %s '%s'", object_type, name)
+            with self.condition:
+                self.last_commit = time.time()
+                self.counts["failed"] += len(batch.failed)
+                self.counts["commits" if result else "failed_commits"] += 1
+            generation.failed = set(batch.failed)
+            generation.result = result
+            generation.done.set()
+
+    def finish_generation(self, result):
+        self.commit_requested = False
+        self.generation.result = result
+        self.generation.done.set()
+        self.generation = Generation()
+
+    def start(self):
+        if os.path.exists(self.socket_path): #left over from a previous run
+            os.unlink(self.socket_path)
+        self.server = BrokerServer(self.socket_path, BrokerHandler)
+        self.server.broker = self
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return self
+
+    #stops accepting changes, and applies and commits the queued ones
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counts)
+            stats["pending"] = len(self.batch)
+            stats["last_commit"] = self.last_commit
+            return stats
+
+def main(argv):
+    import argparse
+    import signal
+    parser = argparse.ArgumentParser(description="Applies the changes of many op5lib clients, and commits them at most once per window")
+    parser.add_argument("--socket", default="/run/op5broker.sock", help="path of the Unix socket to listen on")
+    parser.add_argument("--url", required=True, help="OP5 API URL, e.g. https://op5.example.com/api")
+    parser.add_argument("--window", type=float, default=60, help="minimum number of seconds between commits")
+    parser.add_argument("--no-verify-certificates", action="store_true")
+    args = parser.parse_args(argv)
+    username = os.environ.get("OP5_USERNAME")
+    password = os.environ.get("OP5_PASSWORD")
+    if not username or not password:
+        parser.error("OP5_USERNAME and OP5_PASSWORD must be set in the environment")
+
+    logging.basicConfig(level=logging.INFO)
+    client = op5.OP5(args.url, username, password, logtofile=True, interactive=True, verify_certificates=not args.no_verify_certificates)
+    broker = CommitBroker(client, args.socket, args.window).start()
+    logger.info("Listening on %s, committing at most every %s seconds", args.socket, args.window)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    try:
+        while not stopping.is_set():
+            stopping.wait(1)
+    except KeyboardInterrupt:
+        pass
+    logger.info("Stopping, after applying %d queued changes", broker.stats()["pending"])
+    broker.stop()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
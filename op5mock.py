@@ -0,0 +1,404 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import urllib
+import json
+import copy
+import random
+import re
+import time
+import sys
+
+# A local stand-in for the OP5 REST API, for benchmarks and for trying out scripts without a real OP5 server.
+# It keeps everything in memory and implements the parts of /config, /change, /command, /filter and /report
+# that op5.py uses. Latency, HTTP 509s, 500 "Export failed" and "index mismatch" responses can be injected.
+
+def get_object_name(object_type, data):
+    if object_type == "service":
+        return "%s;%s" % (data.get("host_name") or data.get("hostgroup_name"), data.get("service_description"))
+    for key in [object_type+"_name", "name", "username"]:
+        if key in data:
+            return data[key]
+    return None
+
+#Parses a livestatus-like filter, e.g. '[services] state != 0 and (host_name = "a" or groups >= "web")'
+#RETURNS:
+#the table name, and a function that tells whether a row matches
+def parse_filter(query):
+    match = re.match(r'\s*\[(\w+)\]\s*(.*)$', query, re.S)
+    if not match:
+        raise ValueError("Filter does not start with a [table]: %s" % query)
+    tokens = re.findall(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+', match.group(2))
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        position[0] += 1
+        return tokens[position[0]-1]
+
+    def parse_value(token):
+        if token.startswith('"'):
+            return token[1:-1].replace('\\"', '"')
+        try:
+            return float(token)
+        except ValueError:
+            return token
+
+    def compare(value, op, expected):
+        if isinstance(value, list):
+            return (expected in value) != (op == "!>=") if op in [">=", "!>="] else False
+        if isinstance(expected, float) and not isinstance(value, (int, float)):
+            return False
+        if op == "=":
+            return value == expected
+        if op == "!=":
+            return value != expected
+        if op == "~":
+            return re.search(expected, value) is not None
+        if op == "~~":
+            return re.search(expected, value, re.I) is not None
+        if op == ">":
+            return value > expected
+        if op == ">=":
+            return value >= expected
+        if op == "<":
+            return value < expected
+        if op == "<=":
+            return value <= expected
+        raise ValueError("Unknown operator: %s" % op)
+
+    def parse_factor():
+        token = take()
+        if token == "(":
+            predicate = parse_or()
+            take() # ")"
+            return predicate
+        if token == "not":
+            inner = parse_factor()
+            return lambda row: not inner(row)
+        if token == "all":
+            return lambda row: True
+        op = take()
+        expected = parse_value(take())
+        return lambda row: compare(row.get(token), op, expected)
+
+    def parse_and():
+        predicates = [parse_factor()]
+        while peek() == "and":
+            take()
+            predicates.append(parse_factor())
+        return lambda row: all(predicate(row) for predicate in predicates)
+
+    def parse_or():
+        predicates = [parse_and()]
+        while peek() == "or":
+            take()
+            predicates.append(parse_and())
+        return lambda row: any(predicate(row) for predicate in predicates)
+
+    if not tokens:
+        return match.group(1), lambda row: True
+    return match.group(1), parse_or()
+
+class MockOP5Store(object):
+    """
+    The state of a mock OP5 server: saved and unsaved config objects, check results and events,
+    the faults to inject, and counters of the requests that were received.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.saved = {}     #object_type -> {name: object}
+        self.objects = {}   #the same, including changes that have not been saved yet
+        self.changes = []
+        self.status = {}    #host name or (host name, service description) -> check result
+        self.events = []
+        self.commands = []
+        self.request_counts = {}
+        self.exports = 0
+        self.reference_listings = False #if True, listings only have the name and resource of each object
+
+        #faults
+        self.latency = 0            #seconds added to every request
+        self.export_latency = 0     #seconds that a commit takes
+        self.fail_509 = 0           #number of upcoming requests that get HTTP 509
+        self.fail_509_rate = 0.0    #probability of HTTP 509 for any request
+        self.fail_export = 0        #number of upcoming commits that get HTTP 500 "Export failed"
+        self.fail_index_mismatch = 0 #number of upcoming /config reads that get "index mismatch"
+
+    def count_request(self, key):
+        with self.lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    def take_fault(self, name):
+        with self.lock:
+            if getattr(self, name) > 0:
+                setattr(self, name, getattr(self, name) - 1)
+                return True
+        return False
+
+    def add(self, object_type, data, saved=True):
+        with self.lock:
+            name = get_object_name(object_type, data)
+            self.objects.setdefault(object_type, {})[name] = copy.deepcopy(data)
+            if saved:
+                self.saved.setdefault(object_type, {})[name] = copy.deepcopy(data)
+
+    def get_status(self, key):
+        return self.status.setdefault(key, {"state": 0, "last_check": 0, "last_state_change": 0, "plugin_output": ""})
+
+    def process_check_result(self, host_name, service_description, state, plugin_output):
+        with self.lock:
+            now = int(time.time())
+            status = self.get_status(host_name if service_description is None else (host_name, service_description))
+            if status["state"] != state:
+                status["last_state_change"] = now
+                self.events.append({"timestamp": now, "host_name": host_name, "service_description": service_description,
+                                    "state": state, "output": plugin_output})
+            status.update({"state": state, "last_check": now, "plugin_output": plugin_output})
+
+    def get_rows(self, table):
+        hosts = self.objects.get("host", {})
+        rows = []
+        if table == "hosts":
+            for name, host in hosts.items():
+                row = {"name": name, "address": host.get("address"), "groups": host.get("hostgroups", [])}
+                row.update(self.get_status(name))
+                rows.append(row)
+        elif table == "services":
+            for service in self.objects.get("service", {}).values():
+                if "host_name" in service:
+                    host_names = [service["host_name"]]
+                else:
+                    host_names = [name for name, host in hosts.items() if service.get("hostgroup_name") in host.get("hostgroups", [])]
+                for host_name in host_names:
+                    key = (host_name, service.get("service_description"))
+                    row = {"host_name": host_name, "description": key[1], "check_command": service.get("check_command"),
+                           "groups": service.get("servicegroups", [])}
+                    row.update(self.get_status(key))
+                    rows.append(row)
+        elif table in ["hostgroups", "servicegroups", "contacts", "commands", "timeperiods"]:
+            for name, data in self.objects.get(table[:-1], {}).items():
+                rows.append(dict(data, name=name))
+        else:
+            raise ValueError("Unknown table: %s" % table)
+        return sorted(rows, key=lambda row: (row.get("name"), row.get("host_name"), row.get("description")))
+
+class MockOP5Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" #keep-alive, like the real server
+    wbufsize = -1 #send each response in one go, instead of one packet per header line
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, status_code, data, content_type="application/json"):
+        body = json.dumps(data) if content_type == "application/json" else data
+        self.send_response(status_code)
+        self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, request_type):
+        store = self.server.store
+        url = urlparse.urlparse(self.path)
+        path = url.path[len(self.server.prefix):] if url.path.startswith(self.server.prefix) else url.path
+        parts = [urllib.unquote(part).decode("UTF-8") for part in path.strip("/").split("/")]
+        query = dict((key, values[0]) for key, values in urlparse.parse_qs(url.query).items())
+        length = int(self.headers.get("content-length") or 0)
+        body = self.rfile.read(length) if length else ""
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            return self.reply(400, {"error": "Invalid JSON"})
+
+        store.count_request("%s %s" % (request_type, parts[0]))
+        if store.latency:
+            time.sleep(store.latency)
+        if store.take_fault("fail_509") or (store.fail_509_rate and random.random() < store.fail_509_rate):
+            return self.reply(509, "<html><body>Sanity protection</body></html>", "text/html")
+
+        if parts[0] == "config" and len(parts) > 1 and parts[1] == "change":
+            return self.handle_change(request_type)
+        if parts[0] == "config" and len(parts) > 1:
+            return self.handle_config(request_type, parts[1], "/".join(parts[2:]), data)
+        if parts[0] == "command" and len(parts) > 1 and request_type == "POST":
+            return self.handle_command(parts[1], data or {})
+        if parts[0] == "filter" and len(parts) > 1 and request_type == "GET":
+            return self.handle_filter(parts[1], query)
+        if parts == ["report", "event"] and request_type == "GET":
+            return self.handle_report(query)
+        return self.reply(404, {"error": "No such resource: %s %s" % (request_type, url.path)})
+
+    def handle_change(self, request_type):
+        store = self.server.store
+        with store.lock:
+            if request_type == "GET":
+                return self.reply(200, store.changes)
+            if request_type == "DELETE":
+                store.objects = copy.deepcopy(store.saved)
+                store.changes = []
+                return self.reply(200, {"result": "Changes removed"})
+            if request_type == "POST":
+                if not store.changes:
+                    return self.reply(500, {"error": "Export failed", "full_error": {"type": "nothing to do"}})
+                if store.export_latency:
+                    time.sleep(store.export_latency) #the real server is unavailable during an export, so the lock is held
+                if store.take_fault("fail_export"):
+                    return self.reply(500, {"error": "Export failed", "full_error": {"type": "export error"}})
+                store.saved = copy.deepcopy(store.objects)
+                store.changes = []
+                store.exports += 1
+                return self.reply(200, {"result": "Export successful"})
+        return self.reply(405, {"error": "Method not allowed"})
+
+    def handle_config(self, request_type, object_type, name, data):
+        store = self.server.store
+        with store.lock:
+            if request_type == "GET" and store.take_fault("fail_index_mismatch"):
+                return self.reply(200, "index mismatch", "text/plain")
+            objects = store.objects.setdefault(object_type, {})
+            if request_type == "GET":
+                if name == "":
+                    if store.reference_listings:
+                        return self.reply(200, [{"name": key, "resource": "config/%s/%s" % (object_type, key)} for key in sorted(objects)])
+                    return self.reply(200, [objects[key] for key in sorted(objects)])
+                if name not in objects:
+                    return self.reply(404, {"error": "Object not found", "full_error": "%s '%s' not found" % (object_type, name)})
+                return self.reply(200, objects[name])
+            if request_type == "POST":
+                if not isinstance(data, dict):
+                    return self.reply(400, {"error": "Invalid data"})
+                name = get_object_name(object_type, data)
+                if name is None:
+                    return self.reply(400, {"error": "Required properties not set"})
+                if name in objects:
+                    return self.reply(409, {"error": "Object already exists", "full_error": name})
+                objects[name] = data
+                store.changes.append({"type": "create", "object_type": object_type, "name": name})
+                return self.reply(201, data)
+            if name not in objects:
+                return self.reply(404, {"error": "Object not found", "full_error": "%s '%s' not found" % (object_type, name)})
+            if request_type == "PATCH":
+                objects[name].update(data or {})
+            elif request_type == "PUT":
+                objects[name] = data or {}
+            elif request_type == "DELETE":
+                del objects[name]
+            else:
+                return self.reply(405, {"error": "Method not allowed"})
+            store.changes.append({"type": {"PATCH": "update", "PUT": "update", "DELETE": "delete"}[request_type], "object_type": object_type, "name": name})
+            return self.reply(200, objects.get(name, {"result": "Object deleted"}))
+
+    def handle_command(self, command_type, data):
+        store = self.server.store
+        with store.lock:
+            store.commands.append((command_type, data))
+        if command_type == "PROCESS_SERVICE_CHECK_RESULT":
+            store.process_check_result(data.get("host_name"), data.get("service_description"), int(data.get("status_code", 0)), data.get("plugin_output", ""))
+        elif command_type == "PROCESS_HOST_CHECK_RESULT":
+            store.process_check_result(data.get("host_name"), None, int(data.get("status_code", 0)), data.get("plugin_output", ""))
+        return self.reply(200, {"result": "Successfully submitted %s" % command_type})
+
+    def handle_filter(self, api_type, query):
+        store = self.server.store
+        try:
+            table, predicate = parse_filter(query.get("query", ""))
+            with store.lock:
+                rows = [row for row in store.get_rows(table) if predicate(row)]
+        except (ValueError, re.error) as e:
+            return self.reply(400, {"error": "Invalid query", "full_error": str(e)})
+        if api_type == "count":
+            return self.reply(200, {"count": len(rows)})
+        if api_type != "query":
+            return self.reply(404, {"error": "No such resource: /filter/%s" % api_type})
+        offset = int(query.get("offset", 0))
+        if "limit" in query:
+            rows = rows[offset:offset+int(query["limit"])]
+        else:
+            rows = rows[offset:]
+        if "columns" in query:
+            columns = query["columns"].split(",")
+            rows = [dict((column, row.get(column)) for column in columns) for row in rows]
+        return self.reply(200, rows)
+
+    def handle_report(self, query):
+        store = self.server.store
+        start_time = int(query.get("start_time", 0))
+        end_time = int(query.get("end_time", time.time()))
+        with store.lock:
+            events = [event for event in store.events if start_time <= event["timestamp"] <= end_time
+                      and query.get("host_name", event["host_name"]) == event["host_name"]]
+        return self.reply(200, events)
+
+class MockOP5Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves a MockOP5Store over HTTP. Use url as the api_url of an OP5 object.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, prefix="/api", verbose=False, store=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MockOP5Handler)
+        self.prefix = prefix
+        self.verbose = verbose
+        self.store = store or MockOP5Store()
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d%s" % (self.server_address[0], self.server_address[1], self.prefix)
+
+    #serves requests in a background thread
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Local stand-in for the OP5 REST API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+    parser.add_argument("--export-latency", type=float, default=0, help="seconds that a commit takes")
+    parser.add_argument("--fail-509-rate", type=float, default=0, help="probability of HTTP 509 for any request")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    server = MockOP5Server(args.host, args.port, verbose=args.verbose)
+    server.store.latency = args.latency
+    server.store.export_latency = args.export_latency
+    server.store.fail_509_rate = args.fail_509_rate
+    print "Serving a mock OP5 API at %s" % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
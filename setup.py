@@ -11,10 +11,10 @@ setup(
     version='1.0',
     author='Ozan Safi',
     author_email='ozansafi@gmail.com',
-    py_modules=['op5'],
+    py_modules=['op5', 'op5mock', 'op5broker'],
     description="A python library for OP5's REST API",
     install_requires=[
-        "requests>=2.3.0",
+        "requests>=2.4.0",
         "termcolor>=1.1.0",
     ],
 )
@@ -0,0 +1,404 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import op5
+import op5mock
+import op5broker
+
+# Behaviour tests of op5.py against a local mock OP5 server.
+# Usage: python -m unittest discover tests
+
+class MockServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO() #hide the status text that op5.py prints for every call
+        self.server = op5mock.MockOP5Server().start()
+        self.store = self.server.store
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        sys.stdout = self.stdout
+
+    def client(self, **kwargs):
+        kwargs.setdefault("interactive", True)
+        kwargs.setdefault("retry_wait", 0.01)
+        client = op5.OP5(self.server.url, "user", "password", **kwargs)
+        self.clients.append(client)
+        return client
+
+class RetryTest(MockServerTestCase):
+    def test_509_is_retried(self):
+        self.store.add("host", {"host_name": "host1", "address": "10.0.0.1"})
+        client = self.client(max_retries=3)
+        self.store.fail_509 = 2
+        self.assertTrue(client.read("host", "host1"))
+        self.assertEqual(client.data["address"], "10.0.0.1")
+        self.assertEqual(client.stats.snapshot()["retries"], 2)
+
+    def test_509_raises_after_max_retries(self):
+        client = self.client(max_retries=3)
+        self.store.fail_509 = 3
+        self.assertRaises(RuntimeError, client.read, "host", "host1")
+        self.store.fail_509 = 3
+        self.assertRaises(RuntimeError, client.command, "PROCESS_HOST_CHECK_RESULT", {"host_name": "host1", "status_code": 0, "plugin_output": "OK"})
+
+    def test_500_export_failed_is_retried(self):
+        client = self.client(max_retries=3)
+        self.assertTrue(client.create("host", {"host_name": "host1", "address": "10.0.0.1"}))
+        self.store.fail_export = 1
+        self.assertTrue(client.commit_changes())
+        self.assertEqual(self.store.exports, 1)
+
+    def test_500_raises_after_max_retries(self):
+        client = self.client(max_retries=3)
+        self.assertTrue(client.create("host", {"host_name": "host1", "address": "10.0.0.1"}))
+        self.store.fail_export = 3
+        self.assertRaises(RuntimeError, client.commit_changes)
+        self.assertEqual(self.store.exports, 0)
+        self.assertEqual(client.stats.snapshot()["commits"]["failed"], 1)
+
+    def test_total_timeout_raises(self):
+        client = self.client(max_retries=10, retry_wait=1, total_timeout=1)
+        self.store.fail_509 = 10
+        self.assertRaises(op5.TotalTimeoutError, client.read, "host", "host1")
+
+class CacheTest(MockServerTestCase):
+    def reads(self):
+        return self.store.request_counts.get("GET config", 0)
+
+    def test_reads_are_cached(self):
+        self.store.add("host", {"host_name": "host1", "address": "10.0.0.1"})
+        client = self.client(cache=True)
+        self.assertTrue(client.read("host", "host1"))
+        self.assertTrue(client.read("host", "host1"))
+        self.assertEqual(self.reads(), 1)
+        self.assertEqual(client.cache_stats()["hits"], 1)
+
+    def test_update_invalidates_object_and_listing(self):
+        self.store.add("host", {"host_name": "host1", "address": "10.0.0.1"})
+        client = self.client(cache=True)
+        client.read("host", "host1")
+        client.read("host", "")
+        self.assertTrue(client.update("host", "host1", {"address": "10.0.0.2"}))
+        self.assertTrue(client.read("host", "host1"))
+        self.assertEqual(client.data["address"], "10.0.0.2")
+        self.assertTrue(client.read("host", ""))
+        self.assertEqual(client.data[0]["address"], "10.0.0.2")
+        self.assertEqual(self.reads(), 4)
+
+    def test_create_invalidates_negative_entry(self):
+        client = self.client(cache=True)
+        self.assertFalse(client.read("host", "host1"))
+        self.assertFalse(client.read("host", "host1"))
+        self.assertEqual(self.reads(), 1)
+        self.assertTrue(client.create("host", {"host_name": "host1", "address": "10.0.0.1"}))
+        self.assertTrue(client.read("host", "host1"))
+
+    def test_undo_changes_clears_cache(self):
+        self.store.add("host", {"host_name": "host1", "address": "10.0.0.1"})
+        client = self.client(cache=True)
+        client.update("host", "host1", {"address": "10.0.0.2"})
+        client.read("host", "host1")
+        self.assertTrue(client.undo_changes())
+        self.assertTrue(client.read("host", "host1"))
+        self.assertEqual(client.data["address"], "10.0.0.1")
+
+class QueryManyTest(MockServerTestCase):
+    def test_results_are_in_input_order(self):
+        self.store.add("hostgroup", {"hostgroup_name": "group1", "members": ["host1"]})
+        for i in range(10):
+            self.store.add("host", {"host_name": "host%d" % i, "address": "10.0.0.%d" % i})
+        client = self.client()
+        results = client.query_many([("read", "host", "host%d" % i) for i in range(10)] + [("read", "host", "missing")], max_workers=4)
+        self.assertEqual([result.data["host_name"] for result in results[:10]], ["host%d" % i for i in range(10)])
+        self.assertEqual(results[10][:2], (False, 404))
+
+    def test_missing_group_is_a_failure(self):
+        self.store.add("hostgroup", {"hostgroup_name": "group1", "members": ["host1"]})
+        client = self.client()
+        found, missing = client.query_many([("get_group_members", "hostgroup", "group1"), ("get_group_members", "hostgroup", "missing")])
+        self.assertEqual(found, (True, 200, ["host1"]))
+        self.assertEqual(missing, (False, 404, []))
+
+    def test_writes_are_refused(self):
+        self.assertFalse(self.client().query_many([("create", "host", {"host_name": "host1"})]))
+
+class FilterTest(MockServerTestCase):
+    def test_rows_are_paged(self):
+        for i in range(5):
+            self.store.add("host", {"host_name": "host%d" % i, "address": "10.0.0.%d" % i})
+        client = self.client()
+        rows = list(client.iter_filter("[hosts] all", columns=["name"], page_size=2))
+        self.assertEqual(rows, [{"name": "host%d" % i} for i in range(5)])
+        self.assertEqual(self.store.request_counts["GET filter"], 3)
+
+    def test_page_size_must_be_positive(self):
+        client = self.client()
+        self.assertRaises(ValueError, list, client.iter_filter("[hosts] all", page_size=0))
+
+class ReportTest(MockServerTestCase):
+    def setUp(self):
+        MockServerTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        MockServerTestCase.tearDown(self)
+
+    def requests(self):
+        return self.store.request_counts.get("GET report", 0)
+
+    def test_whole_windows_are_cached(self):
+        client = self.client()
+        cache_dir = os.path.join(self.directory, "reports") #created on first use
+        start = (int(time.time()) / 86400 - 10) * 86400 + 600
+        list(client.iter_report(start, start + 5 * 86400, cache_dir=cache_dir))
+        self.assertEqual(self.requests(), 6)
+        self.assertEqual(len(os.listdir(cache_dir)), 4) #the first and last windows are clipped
+        list(client.iter_report(start + 600, start + 5 * 86400 + 600, cache_dir=cache_dir))
+        self.assertEqual(self.requests(), 8) #only the clipped windows are fetched again
+
+    def test_unsettled_windows_are_not_cached(self):
+        client = self.client()
+        start = (int(time.time()) / 86400 - 3) * 86400
+        list(client.iter_report(start, start + 3 * 86400 - 1, cache_dir=self.directory, cache_delay=2 * 86400))
+        self.assertEqual(len(os.listdir(self.directory)), 1) #only the window that ended more than two days ago
+
+class ChangeBatchTest(MockServerTestCase):
+    def test_calls_to_the_same_object_are_coalesced(self):
+        client = self.client()
+        batch = client.batch()
+        self.assertTrue(batch.create("host", {"host_name": "host1", "address": "10.0.0.1"}))
+        self.assertTrue(batch.update("host", "host1", {"alias": "first"}))
+        self.assertTrue(batch.create("host", {"host_name": "host2", "address": "10.0.0.2"}))
+        self.assertTrue(batch.delete("host", "host2"))
+        self.assertEqual(batch.get_requests(), [("POST", "host", "host1", {"host_name": "host1", "address": "10.0.0.1", "alias": "first"})])
+        self.assertEqual(batch.coalesced, 2)
+
+    def test_conflicting_calls_are_refused(self):
+        client = self.client()
+        batch = client.batch()
+        self.assertTrue(batch.delete("host", "host1"))
+        self.assertFalse(batch.update("host", "host1", {"alias": "first"}))
+        self.assertTrue(batch.create("host", {"host_name": "host1", "address": "10.0.0.1"}))
+        self.assertEqual(batch.get_requests()[0][0], "PUT")
+
+    def test_requests_are_sent_in_dependency_order(self):
+        self.store.add("command", {"command_name": "old_command", "command_line": "true"})
+        self.store.add("host", {"host_name": "old_host", "address": "10.0.0.9"})
+        client = self.client()
+        with client.batch() as batch:
+            batch.create("service", {"host_name": "host1", "service_description": "ping", "check_command": "check_ping"})
+            batch.delete("command", "old_command")
+            batch.create("host", {"host_name": "host1", "address": "10.0.0.1", "hostgroups": ["group1"]})
+            batch.delete("host", "old_host")
+            batch.create("hostgroup", {"hostgroup_name": "group1"})
+            self.assertEqual([(r[0], r[1]) for r in batch.get_requests()],
+                             [("POST", "hostgroup"), ("POST", "host"), ("POST", "service"), ("DELETE", "host"), ("DELETE", "command")])
+        self.assertTrue(batch.result)
+        self.assertEqual(self.store.exports, 1)
+        self.assertIn("host1;ping", self.store.saved["service"])
+
+    def test_failed_request_undoes_the_batch(self):
+        client = self.client()
+        batch = client.batch()
+        batch.create("host", {"host_name": "host1", "address": "10.0.0.1"})
+        batch.update("host", "missing", {"address": "10.0.0.2"})
+        self.assertFalse(batch.flush())
+        self.assertEqual(self.store.exports, 0)
+        self.assertNotIn("host1", self.store.objects.get("host", {}))
+
+    def test_failed_commit_undoes_the_batch(self):
+        client = self.client(max_retries=2)
+        batch = client.batch()
+        batch.create("host", {"host_name": "host1", "address": "10.0.0.1"})
+        self.store.fail_export = 5
+        self.assertRaises(RuntimeError, batch.flush)
+        self.assertEqual(self.store.changes, [])
+        self.assertNotIn("host1", self.store.objects.get("host", {}))
+
+    def test_keep_going_commits_the_rest(self):
+        client = self.client()
+        batch = client.batch()
+        batch.create("host", {"host_name": "host1", "address": "10.0.0.1"})
+        batch.update("host", "missing", {"address": "10.0.0.2"})
+        self.assertTrue(batch.flush(keep_going=True))
+        self.assertEqual(batch.failed, [("host", "missing")])
+        self.assertIn("host1", self.store.saved["host"])
+
+    def test_dryrun_sends_nothing(self):
+        client = self.client(dryrun=True)
+        batch = client.batch()
+        batch.create("host", {"host_name": "host1", "address": "10.0.0.1"})
+        batch.create("hostgroup", {"hostgroup_name": "group1"})
+        self.assertFalse(batch.flush())
+        self.assertEqual(self.store.request_counts, {})
+
+class SnapshotTest(MockServerTestCase):
+    def setUp(self):
+        MockServerTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.store.add("host", {"host_name": "host1", "address": "10.0.0.1"})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        MockServerTestCase.tearDown(self)
+
+    def test_verify_snapshot_bypasses_the_cache(self):
+        client = self.client(cache=True)
+        client.read("host", "")
+        snapshot = client.export_snapshot(self.directory, ["host"])
+        self.assertTrue(client.verify_snapshot(snapshot, ["host"]))
+        self.store.add("host", {"host_name": "host2", "address": "10.0.0.2"})
+        self.assertFalse(client.verify_snapshot(snapshot, ["host"]))
+        plan = client.plan(snapshot, "host", [{"host_name": "host2", "address": "10.0.0.2"}])
+        self.assertFalse(client.apply_plan(snapshot, plan))
+        self.assertEqual(self.store.request_counts.get("POST config", 0), 0)
+
+    def test_dryrun_reads_from_snapshot(self):
+        self.store.add("hostgroup", {"hostgroup_name": "group1"})
+        snapshot = self.client().export_snapshot(self.directory, ["host"])
+        self.store.add("host", {"host_name": "host2", "address": "10.0.0.2"})
+        client = self.client(dryrun=True, snapshot=snapshot)
+        self.assertTrue(client.read("host", "host1"))
+        self.assertFalse(client.read("host", "host2"))
+        self.assertTrue(client.read("hostgroup", "group1")) #not in the snapshot, so read from the server
+        self.assertFalse(client.read("hostgroup", "missing"))
+
+    def test_plan_against_snapshot(self):
+        client = self.client()
+        snapshot = client.export_snapshot(self.directory, ["host"])
+        plan = client.plan(snapshot, "host", [{"host_name": "host1", "address": "10.0.0.9"}, {"host_name": "host2", "address": "10.0.0.2"}])
+        self.assertEqual(plan["update"], [("host1", {"host_name": "host1", "address": "10.0.0.9"})])
+        self.assertEqual(plan["create"], [{"host_name": "host2", "address": "10.0.0.2"}])
+        self.assertTrue(client.apply_plan(snapshot, plan))
+        self.assertEqual(self.store.saved["host"]["host1"]["address"], "10.0.0.9")
+        self.assertEqual(self.store.exports, 1)
+
+class CompactListingTest(MockServerTestCase):
+    def setUp(self):
+        MockServerTestCase.setUp(self)
+        for i in range(3):
+            self.store.add("host", {"host_name": "host%d" % i, "address": "10.0.0.%d" % i, "hostgroups": ["group%d" % (i % 2), "all"]})
+        self.store.add("hostgroup", {"hostgroup_name": "group0", "members": ["host0", "host2", "host9"]})
+
+    def test_listing_lookups(self):
+        client = self.client(compact=True)
+        self.assertTrue(client.read("host", ""))
+        listing = client.data
+        self.assertTrue(isinstance(listing, op5.CompactListing))
+        self.assertEqual(len(listing), 3)
+        self.assertEqual(listing.get("host1"), {"host_name": "host1", "address": "10.0.0.1", "hostgroups": ["group1", "all"]})
+        self.assertEqual(listing.get("missing"), None)
+        self.assertEqual(sorted(listing.find("hostgroups", "group0")), ["host0", "host2"])
+        self.assertEqual(len(listing.find("hostgroups", "all")), 3)
+
+    def test_group_members_do_not_depend_on_the_cache(self):
+        client = self.client(compact=True, cache=True)
+        self.assertEqual(client.get_group_members("hostgroup", "group0"), ["host0", "host2", "host9"])
+        self.assertEqual(sorted(client.find_group_members("hostgroup", "group0")), ["host0", "host2"])
+        self.assertEqual(client.get_group_members("hostgroup", "group0"), ["host0", "host2", "host9"])
+        self.assertEqual(client.find_group_members("hostgroup", "group1"), ["host1"])
+        self.assertEqual(self.store.request_counts.get("GET config"), 2)
+
+class CheckResultQueueTest(MockServerTestCase):
+    def test_full_queue_coalesces_and_drops(self):
+        client = self.client()
+        queue = client.check_result_queue(max_size=2, flush_size=100, flush_interval=60, block=False)
+        self.assertTrue(queue.submit("host1", "ping", 0, "first"))
+        self.assertTrue(queue.submit("host2", "ping", 0, "OK"))
+        self.assertTrue(queue.submit("host1", "ping", 2, "second")) #replaces the queued result of host1
+        self.assertFalse(queue.submit("host3", "ping", 0, "OK")) #dropped
+        queue.close()
+        stats = queue.stats()
+        self.assertEqual((stats["submitted"], stats["coalesced"], stats["dropped"], stats["sent"], stats["pending"]), (4, 1, 1, 2, 0))
+        outputs = dict((data["host_name"], data["plugin_output"]) for command_type, data in self.store.commands)
+        self.assertEqual(outputs, {"host1": "second", "host2": "OK"})
+
+    def test_results_are_sent_in_chunks(self):
+        client = self.client()
+        with client.check_result_queue(flush_size=10, max_workers=4) as queue:
+            for i in range(35):
+                queue.submit("host%d" % i, None, 0, "OK")
+        self.assertEqual(queue.stats()["sent"], 35)
+        self.assertEqual(len(self.store.commands), 35)
+
+    def test_blocked_submit_times_out(self):
+        client = self.client()
+        queue = client.check_result_queue(max_size=1, flush_size=100, flush_interval=60, block=True, timeout=0.1)
+        self.assertTrue(queue.submit("host1", "ping", 0, "OK"))
+        start = time.time()
+        self.assertFalse(queue.submit("host2", "ping", 0, "OK"))
+        self.assertTrue(time.time() - start >= 0.1)
+        queue.close()
+
+class BrokerTest(MockServerTestCase):
+    def setUp(self):
+        MockServerTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, "broker.sock")
+        self.broker = op5broker.CommitBroker(self.client(), self.socket_path, commit_window=0.5).start()
+
+    def tearDown(self):
+        self.broker.stop()
+        shutil.rmtree(self.directory)
+        MockServerTestCase.tearDown(self)
+
+    def commit_all(self, clients):
+        results = {}
+        threads = [threading.Thread(target=lambda c=c: results.__setitem__(c, c.commit_changes())) for c in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [results[c] for c in clients]
+
+    def test_one_commit_per_window(self):
+        nodes = [self.client(broker=self.socket_path) for i in range(5)]
+        for i, node in enumerate(nodes):
+            self.assertTrue(node.create("host", {"host_name": "host%d" % i, "address": "10.0.0.%d" % i}))
+        self.assertEqual(self.commit_all(nodes), [True] * 5)
+        self.assertEqual(self.store.exports, 1)
+        self.assertEqual(len(self.store.saved["host"]), 5)
+
+    def test_next_commit_waits_for_the_window(self):
+        node = self.client(broker=self.socket_path)
+        node.create("host", {"host_name": "host1", "address": "10.0.0.1"})
+        self.assertTrue(node.commit_changes())
+        first_commit = self.broker.stats()["last_commit"]
+        node.create("host", {"host_name": "host2", "address": "10.0.0.2"})
+        self.assertTrue(node.commit_changes())
+        self.assertTrue(self.broker.stats()["last_commit"] - first_commit >= 0.5)
+        self.assertEqual(self.store.exports, 2)
+
+    def test_failed_change_only_fails_its_node(self):
+        good, bad = self.client(broker=self.socket_path), self.client(broker=self.socket_path)
+        self.assertTrue(good.create("host", {"host_name": "goodhost", "address": "10.0.0.1"}))
+        self.assertTrue(bad.update("host", "missing", {"address": "10.0.0.2"}))
+        self.assertEqual(self.commit_all([good, bad]), [True, False])
+        self.assertIn("goodhost", self.store.saved["host"])
+        self.assertEqual(self.broker.stats()["failed"], 1)
+
+    def test_failed_export_is_not_committed_later(self):
+        node = self.client(broker=self.socket_path)
+        node.create("host", {"host_name": "host1", "address": "10.0.0.1"})
+        self.store.fail_export = 10
+        self.assertFalse(node.commit_changes())
+        self.assertEqual(self.store.changes, [])
+        self.store.fail_export = 0
+        node.create("host", {"host_name": "host2", "address": "10.0.0.2"})
+        self.assertTrue(node.commit_changes())
+        self.assertEqual(sorted(self.store.saved["host"]), ["host2"])
+
+if __name__ == "__main__":
+    unittest.main()